@@ -0,0 +1,71 @@
+"""
+Compare reading NetCDF sources block by block with the chunk-aligned strips used by `cog_translate`
+
+Writes a compressed NetCDF band for each source chunk shape, then reads it into 512x512 output blocks
+both ways, reporting the least CPU time of `--repeat` readings, which is dominated by decompressing source chunks.
+
+    python benchmarks/chunk_aligned_reads.py --size 8000 --chunks 200x200 --chunks 1000x1000 --chunks 300x4000
+"""
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import netCDF4
+import numpy
+import rasterio
+
+from dea_cogger.cogeo import DEFAULT_PROFILE, _block_windows, _chunk_aligned_blocks
+
+BLOCK_SIZE = DEFAULT_PROFILE['blockxsize']
+
+
+def write_source(filename, size, chunk_shape):
+    with netCDF4.Dataset(filename, 'w') as nco:
+        nco.createDimension('y', size)
+        nco.createDimension('x', size)
+        band = nco.createVariable('band', 'int16', ('y', 'x'), zlib=True, chunksizes=chunk_shape)
+        rows = numpy.arange(size, dtype='int16')[:, None]
+        for row_start in range(0, size, chunk_shape[0]):
+            row_stop = min(row_start + chunk_shape[0], size)
+            band[row_start:row_stop] = (rows[row_start:row_stop] + numpy.arange(size, dtype='int16')) % 1000
+
+
+def block_by_block(src, windows, indexes):
+    for window in windows:
+        yield window, src.read(window=window, indexes=indexes)
+
+
+def cpu_seconds(blocks):
+    start = time.process_time()
+    for _ in blocks:
+        pass
+    return time.process_time() - start
+
+
+@click.command()
+@click.option('--size', default=8000, help='Width and height of the source band')
+@click.option('--chunks', multiple=True, default=['200x200', '1000x1000', '300x4000'],
+              help='Source chunk shapes, as ROWSxCOLS')
+@click.option('--repeat', default=3, help='Readings of each source each way, the fastest is reported')
+def main(size, chunks, repeat):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for chunk in chunks:
+            chunk_shape = tuple(int(length) for length in chunk.split('x'))
+            filename = Path(tmp_dir) / f'source_{chunk}.nc'
+            write_source(filename, size, chunk_shape)
+
+            # Each reading opens the file again, so neither starts with chunks already cached
+            results = {}
+            for _ in range(repeat):
+                for name, reader in (('block by block', block_by_block), ('chunk aligned', _chunk_aligned_blocks)):
+                    with rasterio.open(f'NETCDF:"{filename}":band') as src:
+                        windows = _block_windows(src.width, src.height, BLOCK_SIZE, BLOCK_SIZE)
+                        seconds = cpu_seconds(reader(src, windows, [1]))
+                    results[name] = min(seconds, results.get(name, seconds))
+
+            print(f'{chunk:>10} chunks: ' + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in results.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Compare the time and output of the gtiff and cog COG engines
+
+Writes a single band source, converts it `--repeat` times with each engine, and reports the fastest
+conversion, the output size, and the largest pixel difference between the engines at every pyramid level.
+The full resolution pixels should be identical. Overviews can differ a little with `average`, as the
+gtiff engine averages each level from the full resolution blocks, see `dea_cogger.overviews`.
+
+    python benchmarks/cog_engines.py --size 4000 --resampling average
+"""
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import gdal
+import numpy
+import rasterio
+from rasterio.transform import from_origin
+
+from dea_cogger.cogeo import DEFAULT_GDAL_CONFIG, DEFAULT_PROFILE, COG_ENGINES
+
+NODATA = -999
+
+
+def write_source(path, size):
+    # Smooth with noise and a nodata corner, compressing about as well as a surface reflectance band
+    rows, cols = numpy.mgrid[0:size, 0:size]
+    random = numpy.random.RandomState(0)
+    data = (1000 + 500 * numpy.sin(rows / 150) * numpy.cos(cols / 200) + random.normal(0, 20, (size, size)))
+    data = data.astype('int16')
+    data[:size // 4, :size // 3] = NODATA
+    with rasterio.open(path, 'w', driver='GTiff', width=size, height=size, count=1, dtype='int16',
+                       nodata=NODATA, crs='EPSG:3577', transform=from_origin(1500000, -3900000, 25, 25),
+                       tiled=True, blockxsize=512, blockysize=512) as dst:
+        dst.write(data, 1)
+
+
+def read_pyramid(path):
+    band = gdal.Open(path).GetRasterBand(1)
+    return [band.ReadAsArray()] + [band.GetOverview(i).ReadAsArray() for i in range(band.GetOverviewCount())]
+
+
+def convert_seconds(engine, src_path, dst_path, resampling):
+    if os.path.exists(dst_path):
+        os.remove(dst_path)
+    start = time.perf_counter()
+    COG_ENGINES[engine](src_path, dst_path, dict(DEFAULT_PROFILE, predictor=2), indexes=[1],
+                        overview_resampling=resampling, config=DEFAULT_GDAL_CONFIG)
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option('--size', default=4000, help='Width and height of the source band')
+@click.option('--resampling', type=click.Choice(['nearest', 'average', 'mode']), default='average')
+@click.option('--repeat', default=3, help='Conversions with each engine, the fastest is reported')
+def main(size, resampling, repeat):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src_path = str(Path(tmp_dir) / 'source.tif')
+        write_source(src_path, size)
+
+        outputs = {}
+        for engine in sorted(COG_ENGINES):
+            outputs[engine] = str(Path(tmp_dir) / f'{engine}.tif')
+            seconds = min(convert_seconds(engine, src_path, outputs[engine], resampling) for _ in range(repeat))
+            print(f'{engine:>6}: {seconds:.2f}s, {os.path.getsize(outputs[engine]) / 2 ** 20:.1f} MB')
+
+        pyramids = [read_pyramid(outputs[engine]) for engine in sorted(COG_ENGINES)]
+        if len(set(len(pyramid) for pyramid in pyramids)) > 1:
+            print(f'Different numbers of levels: {[len(pyramid) for pyramid in pyramids]}')
+        for level_no, levels in enumerate(zip(*pyramids)):
+            difference = numpy.abs(levels[0].astype('int32') - levels[1]).max()
+            print(f'level {level_no} {levels[0].shape[1]}x{levels[0].shape[0]}: '
+                  f'{"identical" if difference == 0 else f"differ by up to {difference}"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Measure the per task overhead of converting many small tiles, with and without a `ConversionContext`
+
+Writes small single band tiles, then converts each of them `--tasks-per-tile` times, as the time slices
+of a stacked file are, first setting everything up for each task as before, then within one context
+reusing its converter, GDAL environment and open datasets. Reports the mean time per task.
+
+With `--ranks`, also reports the time per task of the first of that many MPI ranks within a context, given
+every nth task as before or a contiguous slice of the tasks, with all the tasks of a tile, by `tasks_of_rank`.
+
+    python benchmarks/conversion_context.py --tiles 200 --size 256 --ranks 8
+"""
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy
+import rasterio
+from rasterio.transform import from_origin
+
+from dea_cogger.cogeo import DEFAULT_GDAL_CONFIG, DEFAULT_PROFILE, ConversionContext, NetCDFCOGConverter, \
+    cog_translate
+from dea_cogger.utils import tasks_of_rank
+
+PRODUCT_CONFIG = {'default_resampling': 'average', 'black_list': ['dataset'], 'predictor': 2}
+
+
+def write_tiles(tile_dir, tiles, size):
+    random = numpy.random.RandomState(0)
+    paths = []
+    for tile_no in range(tiles):
+        path = tile_dir / f'tile_{tile_no:05d}.tif'
+        with rasterio.open(path, 'w', driver='GTiff', width=size, height=size, count=1, dtype='int16',
+                           nodata=-999, crs='EPSG:3577', transform=from_origin(1500000, -3900000, 25, 25),
+                           tiled=True, blockxsize=256, blockysize=256) as dst:
+            dst.write(random.randint(0, 10000, size=(1, size, size)).astype('int16'))
+        paths.append(str(path))
+    return paths
+
+
+def convert(converter, src_path, dst_path):
+    # What NetCDFCOGConverter.generate_cog_files and _netcdf_to_cogs do for each band
+    if converter.datasets is not None:
+        converter.datasets.retain(src_path)
+    profile = dict(DEFAULT_PROFILE, predictor=converter.predictor)
+    cog_translate(src_path, dst_path, profile, indexes=[1], overview_resampling=converter.default_resampling,
+                  config=DEFAULT_GDAL_CONFIG, datasets=converter.datasets)
+
+
+def per_task_seconds(tasks, out_dir, context=None):
+    start = time.perf_counter()
+    for task_no, src_path in enumerate(tasks):
+        if context is None:
+            converter = NetCDFCOGConverter(**PRODUCT_CONFIG)
+        else:
+            converter = context.converter(PRODUCT_CONFIG)
+        convert(converter, src_path, str(out_dir / f'out_{task_no:06d}.tif'))
+    return (time.perf_counter() - start) / len(tasks)
+
+
+@click.command()
+@click.option('--tiles', default=200, help='Number of source tiles')
+@click.option('--size', default=256, help='Width and height of the tiles')
+@click.option('--tasks-per-tile', default=4, help='Conversions of each tile, one after the other')
+@click.option('--ranks', default=1, help='Also compare the task dispatch of the first of this many MPI ranks')
+def main(tiles, size, tasks_per_tile, ranks):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        tile_paths = write_tiles(tmp_dir, tiles, size)
+        tasks = [path for path in tile_paths for _ in range(tasks_per_tile)]
+
+        (tmp_dir / 'per_task').mkdir()
+        (tmp_dir / 'context').mkdir()
+
+        results = {'per task setup': per_task_seconds(tasks, tmp_dir / 'per_task')}
+        with ConversionContext(DEFAULT_GDAL_CONFIG) as context:
+            results['conversion context'] = per_task_seconds(tasks, tmp_dir / 'context', context)
+
+        if ranks > 1:
+            contiguous = [src_path for src_path, in tasks_of_rank([(task,) for task in tasks], 0, ranks)]
+            for name, rank_tasks in (('every nth task', tasks[::ranks]), ('contiguous slice', contiguous)):
+                (tmp_dir / name).mkdir()
+                with ConversionContext(DEFAULT_GDAL_CONFIG) as context:
+                    results[f'rank 0 of {ranks}, {name}'] = per_task_seconds(rank_tasks, tmp_dir / name, context)
+
+        timings = ', '.join(f'{name} {seconds * 1000:.1f} ms' for name, seconds in results.items())
+        print(f'{len(tasks)} tasks of {size}x{size} pixels, per task: {timings}')
+
+
+if __name__ == '__main__':
+    main()
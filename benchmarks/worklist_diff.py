@@ -0,0 +1,98 @@
+"""
+Compare the memory and time of the set-based and streaming work list diffs
+
+Writes a synthetic S3 key list, where one dataset in ten has no outputs and one in seventeen of the
+others is missing its YAML, then diffs the datasets against it both ways, each in a fresh process so
+its peak memory is its own. About 4.45 keys are written per dataset.
+
+    python benchmarks/worklist_diff.py --datasets 2500000
+"""
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from dea_cogger.worklist_diff import dataset_lines, external_sort, inventory_output_lines, merge_diff, \
+    output_suffixes
+
+BANDS = ['BS', 'PV', 'NPV', 'UE']
+
+
+def basename(dataset_no):
+    return f'fc/v2/ls7/x_{dataset_no % 97}/y_{dataset_no // 97}/LS7_FC_{dataset_no:09d}'
+
+
+def write_key_list(filename, datasets):
+    keys = 0
+    with open(filename, 'w') as fout:
+        for dataset_no in range(datasets):
+            if dataset_no % 10:
+                for band in BANDS:
+                    fout.write(f'{basename(dataset_no)}_{band}.tif\n')
+                keys += len(BANDS)
+                if dataset_no % 17:
+                    fout.write(f'{basename(dataset_no)}.yaml\n')
+                    keys += 1
+    return keys
+
+
+def dataset_values(datasets):
+    """
+    Yield ``(uri, basename)`` of every dataset, in a scrambled order as a datacube query returns them
+    """
+    for i in range(datasets):
+        dataset_no = (i * 7919) % datasets
+        yield f'file:///g/data/{dataset_no}.nc', basename(dataset_no)
+
+
+def set_diff(key_list, datasets, suffixes):
+    with open(key_list) as fin:
+        existing_keys = set(line.strip() for line in fin)
+    return sum(1 for _, name in dataset_values(datasets)
+               if not all(name + suffix in existing_keys for suffix in suffixes))
+
+
+def streaming_diff(key_list, datasets, suffixes):
+    tmp_dir = Path(key_list).parent
+    with open(key_list) as fin:
+        missing = merge_diff(external_sort(dataset_lines(dataset_values(datasets)), tmp_dir=tmp_dir),
+                             external_sort(inventory_output_lines(fin, suffixes), tmp_dir=tmp_dir),
+                             suffixes)
+        return sum(1 for _ in missing)
+
+
+DIFFS = {'set': set_diff, 'streaming': streaming_diff}
+
+
+@click.command()
+@click.option('--datasets', default=2500000, help='Number of datasets')
+@click.option('--key-list', type=click.Path(dir_okay=False), default=None,
+              help='Diff against this existing key list, as written by a previous run, instead of a new one')
+@click.option('--diff', type=click.Choice(sorted(DIFFS)), default=None,
+              help='Only run this diff in this process, otherwise run both in fresh processes')
+def main(datasets, key_list, diff):
+    suffixes = output_suffixes(BANDS)
+
+    if diff is not None:
+        start = time.perf_counter()
+        missing = DIFFS[diff](key_list, datasets, suffixes)
+        max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f'{diff:>10}: {missing} datasets missing outputs, {time.perf_counter() - start:.1f}s, '
+              f'peak memory {max_rss_mb:.0f} MB')
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        key_list = Path(tmp_dir) / 'keys.txt'
+        keys = write_key_list(key_list, datasets)
+        print(f'{datasets} datasets, {keys} keys')
+        for name in sorted(DIFFS):
+            subprocess.run([sys.executable, __file__, '--datasets', str(datasets), '--key-list', str(key_list),
+                            '--diff', name], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,3 +26,13 @@ then
     yamllint "${YAML_FILES[@]}"
     set +x
 fi
+
+# Importing the CLI must not load the heavy conversion dependencies, each subcommand imports those it needs.
+# Print the slowest imports (cumulative microseconds) for comparison between changes.
+python -X importtime -c 'import dea_cogger.cog_conv_app' 2>&1 | sort -t '|' -k 2 -n | tail -n 10
+python -c '
+import sys
+import dea_cogger.cog_conv_app
+heavy = sorted({"datacube", "gdal", "osgeo", "rasterio", "xarray", "numpy", "netCDF4"} & set(sys.modules))
+assert not heavy, f"dea_cogger.cog_conv_app imports heavy modules at import time: {heavy}"
+'
@@ -52,3 +52,38 @@ def list_inventory(manifest, s3=None, **kw):
         for rec in csv_rdr:
             rec = SimpleNamespace(**{k: v for k, v in zip(schema, rec)})
             yield rec
+
+
+class PrefixTrie:
+    """
+    Character trie of key prefixes, finding every prefix of a key in a single walk along the key
+
+    The cost of a lookup depends on the length of the longest matching prefix, not the number of prefixes.
+    """
+
+    def __init__(self, prefixes=None):
+        """
+        :param prefixes: optional dict of value to prefix
+        """
+        self.root = {}
+        for value, prefix in (prefixes or {}).items():
+            self.add(prefix, value)
+
+    def add(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(value)
+
+    def matches(self, key):
+        """
+        Return the values of all the prefixes `key` starts with
+        """
+        node = self.root
+        values = list(node.get(None, ()))
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                break
+            values.extend(node.get(None, ()))
+        return values
@@ -1,7 +1,12 @@
 import boto3
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fnmatch import fnmatch
 from urllib.parse import urlparse
 
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
 log = logging.getLogger(__name__)
 
 
@@ -23,20 +28,33 @@ def _auto_find_region(session=None):
 def make_s3_client(region_name=None,
                    session=None,
                    profile=None,
-                   use_ssl=True):
+                   use_ssl=True,
+                   endpoint_url=None,
+                   max_pool_connections=None):
+    """
+    :param endpoint_url: override the regional AWS endpoint, eg. for a local S3 compatible server
+    :param max_pool_connections: size of the HTTP connection pool, when sharing the client between threads
+    """
     if session is None:
         if profile is None:
             session = boto3.session.Session()
         else:
             session = boto3.session.Session(profile_name=profile)
 
-    if region_name is None:
-        region_name = _auto_find_region(session)
+    if endpoint_url is None:
+        if region_name is None:
+            region_name = _auto_find_region(session)
 
-    protocol = 'https' if use_ssl else 'http'
+        protocol = 'https' if use_ssl else 'http'
+        endpoint_url = '{}://s3.{}.amazonaws.com'.format(protocol, region_name)
+
+    config = None
+    if max_pool_connections is not None:
+        config = Config(max_pool_connections=max_pool_connections)
 
     s3 = session.client('s3',
-                        endpoint_url='{}://s3.{}.amazonaws.com'.format(protocol, region_name))
+                        endpoint_url=endpoint_url,
+                        config=config)
     return s3
 
 
@@ -69,6 +87,54 @@ def s3_ls_dir(uri, s3=None, aws_profile=None):
             yield 's3://{bucket}/{path}'.format(bucket=bucket, path=o['Key'])
 
 
+def _s3_list_level(s3, bucket, prefix):
+    """
+    List one level under a prefix, returning its sub-prefixes and the keys of its objects
+    """
+    sub_dirs, keys = [], []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        sub_dirs.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        keys.extend(o['Key'] for o in page.get('Contents', []))
+    return sub_dirs, keys
+
+
+def s3_list_keys(uri, pattern=None, s3=None, aws_profile=None, max_concurrency=32):
+    """
+    Yield the keys of every object under an S3 prefix, listing the prefix tree concurrently
+
+    Each level is listed with a delimiter, and every sub-prefix found is listed in turn on a pool
+    of at most `max_concurrency` threads, rather than paging through the whole prefix serially.
+
+    :param pattern: optional glob for each of the first levels below the prefix, eg. 'x_*/y_*'.
+                    Sub-prefixes which don't match are not listed.
+    """
+    bucket, prefix = _s3_url_parse(uri)
+    if len(prefix) > 0 and not prefix.endswith('/'):
+        prefix += '/'
+
+    if not s3:
+        s3 = make_s3_client(profile=aws_profile, max_pool_connections=max_concurrency)
+
+    levels = pattern.strip('/').split('/') if pattern else []
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = {executor.submit(_s3_list_level, s3, bucket, prefix): 0}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                depth = pending.pop(future)
+                sub_dirs, keys = future.result()
+
+                yield from keys
+
+                for sub_dir in sub_dirs:
+                    name = sub_dir.rstrip('/').split('/')[-1]
+                    if depth < len(levels) and not fnmatch(name, levels[depth]):
+                        continue
+                    pending[executor.submit(_s3_list_level, s3, bucket, sub_dir)] = depth + 1
+
+
 def s3_fetch(url, s3=None, aws_profile=None, **kwargs):
     if not s3:
         s3 = make_s3_client(profile=aws_profile)
@@ -76,3 +142,26 @@ def s3_fetch(url, s3=None, aws_profile=None, **kwargs):
     bucket, key = _s3_url_parse(url)
     oo = s3.get_object(Bucket=bucket, Key=key, **kwargs)
     return oo['Body'].read()
+
+
+def s3_fetch_range(url, start, stop, s3=None, aws_profile=None):
+    """
+    Fetch bytes ``[start, stop)`` of an S3 object with an HTTP Range request
+    """
+    return s3_fetch(url, s3=s3, aws_profile=aws_profile, Range='bytes={}-{}'.format(start, stop - 1))
+
+
+def s3_last_modified(url, s3=None, aws_profile=None):
+    """
+    Return the modification time of an S3 object, or None if it doesn't exist
+    """
+    if not s3:
+        s3 = make_s3_client(profile=aws_profile)
+
+    bucket, key = _s3_url_parse(url)
+    try:
+        return s3.head_object(Bucket=bucket, Key=key)['LastModified']
+    except ClientError as exc:
+        if exc.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
@@ -0,0 +1,171 @@
+"""
+Local SQLite catalog of the datasets of each product and their conversion state
+
+Lets generate-work-list ask the datacube only for the datasets added or updated since its last run,
+instead of re-querying, and re-checking on S3, every dataset of the product each time.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import structlog
+
+LOG = structlog.get_logger()
+
+# Never converted, so any outputs found on S3 will do
+PENDING = 'pending'
+# Updated in the datacube or converted with another profile since its outputs were uploaded, only outputs
+# uploaded after `stale_since` will do
+STALE = 'stale'
+UPLOADED = 'uploaded'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dataset (
+    uri TEXT PRIMARY KEY,
+    product TEXT NOT NULL,
+    basename TEXT NOT NULL,
+    mtime REAL,
+    size INTEGER,
+    profile_hash TEXT NOT NULL,
+    state TEXT NOT NULL,
+    changed TEXT,
+    stale_since REAL
+);
+CREATE INDEX IF NOT EXISTS dataset_product_state ON dataset (product, state);
+CREATE TABLE IF NOT EXISTS watermark (
+    product TEXT PRIMARY KEY,
+    changed TEXT NOT NULL
+);
+"""
+
+
+# Options of a product's configuration which change the content of its outputs. The others, eg. the prefix
+# and name template, only decide where they're written.
+OUTPUT_OPTIONS = ('black_list', 'white_list', 'no_overviews', 'default_resampling', 'bands_rsp', 'predictor',
+                  'sparse', 'engine', 'byte_nodata', 'multi_band')
+
+
+def _hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+def profile_hash(product_config):
+    """
+    Hash of the options of a product's configuration changing its outputs, outputs made with different ones are stale
+    """
+    return _hash({key: value for key, value in product_config.items() if key in OUTPUT_OPTIONS})
+
+
+def whole_config_hash(product_config):
+    """
+    Hash of a product's whole configuration, the profile hash of catalogs written by earlier versions
+    """
+    return _hash(product_config)
+
+
+class ConversionCatalog:
+    """
+    Record of every source dataset of a product, its output basename, conversion profile and upload state
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(str(filename))
+        self.db.executescript(SCHEMA)
+
+        # Catalogs created before the stale state was added
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(dataset)')]
+        for column, column_type in (('changed', 'TEXT'), ('stale_since', 'REAL')):
+            if column not in columns:
+                self.db.execute(f'ALTER TABLE dataset ADD COLUMN {column} {column_type}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.db.commit()
+        self.db.close()
+
+    def watermark(self, product):
+        """
+        Return the latest change time of the product's datasets already recorded, or None
+        """
+        row = self.db.execute('SELECT changed FROM watermark WHERE product = ?', (product,)).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, product, changed):
+        # INSERT OR REPLACE rather than an upsert, which needs SQLite 3.24
+        self.db.execute('INSERT OR REPLACE INTO watermark (product, changed) VALUES (?, ?)', (product, changed))
+        self.db.commit()
+
+    def add(self, product, uri, basename, profile, changed):
+        """
+        Record a source dataset added or updated in the datacube at time `changed`
+
+        A new dataset is pending conversion. One already recorded with another change time has been
+        updated, and its outputs are stale.
+        """
+        row = self.db.execute('SELECT changed, profile_hash, state, stale_since FROM dataset WHERE uri = ?',
+                              (uri,)).fetchone()
+        if row is None:
+            state, stale_since = PENDING, None
+        elif row[0] == changed.isoformat():
+            # Seen again at the watermark, it hasn't changed
+            return
+        else:
+            state, stale_since = STALE, changed.timestamp()
+
+        path = uri.split('file://')[-1].split('#')[0]
+        try:
+            stat = os.stat(path)
+            mtime, size = stat.st_mtime, stat.st_size
+        except OSError:
+            mtime = size = None
+
+        self.db.execute('INSERT OR REPLACE INTO dataset '
+                        '(uri, product, basename, mtime, size, profile_hash, state, changed, stale_since) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (uri, product, basename, mtime, size, profile, state, changed.isoformat(), stale_since))
+
+    def remove(self, uris):
+        """
+        Forget datasets, eg. once they're archived in the datacube
+        """
+        self.db.executemany('DELETE FROM dataset WHERE uri = ?', ((uri,) for uri in uris))
+        self.db.commit()
+
+    def reprofile(self, product, profile, same_profiles=()):
+        """
+        Mark the datasets converted with a different profile as stale from now
+
+        Datasets recorded with one of `same_profiles`, other hashes of the same configuration, eg. by an
+        earlier version, and datasets never converted, only have their hash updated.
+        """
+        self.db.executemany('UPDATE dataset SET profile_hash = ? WHERE product = ? AND profile_hash = ?',
+                            ((profile, product, same_profile) for same_profile in same_profiles))
+        self.db.execute('UPDATE dataset SET profile_hash = ? WHERE product = ? AND state = ?',
+                        (profile, product, PENDING))
+        self.db.execute('UPDATE dataset SET profile_hash = ?, state = ?, stale_since = ? '
+                        'WHERE product = ? AND profile_hash != ?',
+                        (profile, STALE, time.time(), product, profile))
+        self.db.commit()
+
+    def pending(self, product):
+        """
+        Return ``(uri, basename)`` of the product's datasets never converted
+        """
+        return self.db.execute('SELECT uri, basename FROM dataset WHERE product = ? AND state = ?',
+                               (product, PENDING)).fetchall()
+
+    def stale(self, product):
+        """
+        Return ``(uri, basename, stale_since)`` of the product's datasets whose outputs are out of date
+        """
+        return self.db.execute('SELECT uri, basename, stale_since FROM dataset WHERE product = ? AND state = ?',
+                               (product, STALE)).fetchall()
+
+    def mark_uploaded(self, uris):
+        self.db.executemany('UPDATE dataset SET state = ?, stale_since = NULL WHERE uri = ?',
+                            ((UPLOADED, uri) for uri in uris))
+        self.db.commit()
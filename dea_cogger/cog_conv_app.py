@@ -8,11 +8,13 @@ To use on the NCI, load the ``dea`` module by running::
     $ module load dea
 """
 import csv
+import multiprocessing
 import os
 import shutil
 import socket
-import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from functools import partial
 from os.path import splitext
 from pathlib import Path
@@ -20,21 +22,30 @@ from pathlib import Path
 import click
 import structlog
 import yaml
-from datacube.ui.expression import parse_expressions
 from tqdm import tqdm
 
 from dea_cogger import __version__
-from dea_cogger.aws_inventory import list_inventory
+from dea_cogger.aws_inventory import list_inventory, PrefixTrie
+from dea_cogger.aws_s3_client import make_s3_client, s3_list_keys, s3_last_modified, _s3_url_parse
+from dea_cogger.catalog import ConversionCatalog, profile_hash, whole_config_hash
+from dea_cogger.profiling import profile_run, parse_ranks
+from dea_cogger.resources import apply_resource_plan
+from dea_cogger.verification import iter_geotiffs, iter_listed_geotiffs, validate_geotiff, validate_remote_geotiffs, \
+    VerifiedCache
+from dea_cogger.worklist_diff import external_sort, dataset_lines, inventory_output_lines, merge_diff, \
+    output_suffixes
 from dea_cogger.utils import get_dataset_values, validate_time_range, _convert_cog, expected_bands, _mpi_init, \
-    nth_by_mpi
+    nth_by_mpi, estimate_task_cost, task_cost, shard_tasks, tasks_of_rank, get_changed_dataset_values, \
+    input_from_uri, get_archived_dataset_uris
 
 LOG = structlog.get_logger()
 
 PACKAGE_DIR = Path(__file__).absolute().parent
 CONFIG_FILE_PATH = PACKAGE_DIR / 'aws_products_config.yaml'
-VALIDATE_GEOTIFF_CMD = PACKAGE_DIR / 'validate_cloud_optimized_geotiff.py'
 S3_LIST_EXT = '_s3_inv_list.txt'
 TASK_FILE_EXT = '_file_list.txt'
+FAILED_TASKS_FILE = 'failed_tasks.csv'
+MAX_RETRY_DELAY = 300
 
 # pylint: disable=invalid-name
 output_dir_option = click.option('--output-dir', '-o', required=True,
@@ -54,6 +65,14 @@ s3_inv_option = click.option('--inventory-manifest', '-i',
                              metavar='S3_URL',
                              help="The manifest of AWS S3 bucket inventory URL")
 
+profile_option = click.option('--profile', 'profile_dir', default=None,
+                              type=click.Path(file_okay=False, writable=True),
+                              help='Sample the call stacks of the run, writing per rank and merged collapsed stack '
+                                   'files, eg. for flamegraph.pl or speedscope, to this directory')
+
+profile_ranks_option = click.option('--profile-ranks', default=None, callback=parse_ranks,
+                                    help='With --profile, the comma separated MPI ranks to sample (default: all)')
+
 config_file_option = click.option('--config', '-c', default=CONFIG_FILE_PATH,
                                   show_default=True,
                                   type=click.Path(exists=True),
@@ -117,11 +136,14 @@ def cli():
 
 
 @cli.command(name='save-s3-inventory', help="Save S3 inventory list in a text file")
-@product_option
+@click.option('--product-name', '-p', default=None,
+              help="Product name as defined in product configuration file")
+@click.option('--all-products', is_flag=True, default=False,
+              help="Save the lists of every product in the configuration file from a single inventory scan")
 @output_dir_option
 @config_file_option
 @s3_inv_option
-def save_s3_inventory(product_name, output_dir, config, inventory_manifest):
+def save_s3_inventory(product_name, all_products, output_dir, config, inventory_manifest):
     """
     Save a list of S3 objects stored for a product
 
@@ -130,16 +152,61 @@ def save_s3_inventory(product_name, output_dir, config, inventory_manifest):
     Save those file into a text file for further processing.
     Uses a configuration file to define the file naming schema.
 
+    """
+    if (product_name is None) == (not all_products):
+        raise click.UsageError('Specify exactly one of --product-name or --all-products')
+
+    with open(config) as config_file:
+        config = yaml.safe_load(config_file)
+
+    product_names = list(config['products']) if all_products else [product_name]
+    prefixes = PrefixTrie({name: config['products'][name]['prefix'] for name in product_names})
+
+    outfiles = {name: open(Path(output_dir) / (name + S3_LIST_EXT), 'wt') for name in product_names}
+    counts = dict.fromkeys(product_names, 0)
+    try:
+        for result in list_inventory(inventory_manifest):
+            # Route the key to every product whose prefix it starts with
+            for name in prefixes.matches(result.Key):
+                outfiles[name].write(result.Key + '\n')
+                counts[name] += 1
+    finally:
+        for outfile in outfiles.values():
+            outfile.close()
+
+    LOG.info('Saved S3 inventory lists', keys=counts)
+
+
+@cli.command(name='save-s3-listing', help="Save a live S3 listing of a product in the same format as save-s3-inventory")
+@product_option
+@output_dir_option
+@config_file_option
+@click.option('--s3-bucket-url', default='s3://dea-public-data', show_default=True, metavar='S3_URL',
+              help="S3 URL of the bucket holding the product")
+@click.option('--pattern', default=None,
+              help="Optional glob for each of the first levels below the product prefix, eg. 'x_*/y_*'")
+@click.option('--concurrency', type=click.IntRange(min=1), default=32, show_default=True,
+              help="Maximum number of concurrent S3 list requests")
+def save_s3_listing(product_name, output_dir, config, s3_bucket_url, pattern, concurrency):
+    """
+    Save a list of S3 objects stored for a product by listing the bucket directly
+
+    A fallback for when the S3 Inventory, which lags by a day, isn't recent enough. The product prefix
+    tree is walked concurrently, and the output can be used by generate-work-list in the same way.
     """
     with open(config) as config_file:
         config = yaml.safe_load(config_file)
 
     prefix = config['products'][product_name]['prefix']
+    s3_url = s3_bucket_url.rstrip('/') + '/' + prefix
+
+    count = 0
     with open(Path(output_dir) / (product_name + S3_LIST_EXT), 'wt') as outfile:
-        for result in list_inventory(inventory_manifest):
-            # Get the list for the product we are interested
-            if result.Key.startswith(prefix):
-                outfile.write(result.Key + '\n')
+        for key in s3_list_keys(s3_url, pattern=pattern, max_concurrency=concurrency):
+            outfile.write(key + '\n')
+            count += 1
+
+    LOG.info('Saved S3 listing', product=product_name, prefix=s3_url, keys=count)
 
 
 @cli.command(help='Download an entire S3 Inventory and save in an efficient DAWG file')
@@ -165,14 +232,55 @@ def save_dawg(output_file, inventory_manifest):
                    " time in 2020  OR\n"
                    " 'time in 2018-12-31'  OR\n"
                    " 'time in [2018-12-01, 2018-12-31]'")
+@click.option('--shards', type=click.IntRange(min=1), default=None,
+              help='Also split the task list into this many cost balanced task files, eg. for PBS array jobs')
+@click.option('--catalog', type=click.Path(dir_okay=False), default=None,
+              help='SQLite conversion catalog, only datasets changed since the previous run are queried')
+@click.option('--s3-bucket-url', default='s3://dea-public-data', show_default=True, metavar='S3_URL',
+              help="S3 URL of the bucket holding the product, to check when the outputs of catalog datasets "
+                   "which changed were uploaded")
+@click.option('--concurrency', type=click.IntRange(min=1), default=32, show_default=True,
+              help="Number of catalog datasets whose outputs are checked on S3 concurrently")
+@click.option('--streaming-diff', is_flag=True, default=False,
+              help='Compare against the S3 list by sorting and merging on disk, instead of loading it into memory')
 @config_file_option
-def generate_work_list(product_name, output_dir, s3_list, time_range, config):
+@profile_option
+@profile_ranks_option
+def generate_work_list(product_name, output_dir, s3_list, time_range, shards, catalog, s3_bucket_url, concurrency,
+                       streaming_diff, config, profile_dir, profile_ranks):
     """
     Compares datacube file uri's against S3 bucket (file names within text file) and writes the list of datasets
     for conversion into the task file
 
+    Each task is written with an estimated cost: input bytes, pixels per band and band count.
+
+    With a --catalog, the datasets of the product and their upload state are remembered between runs,
+    so only the datasets added or updated in the datacube since the last run are queried, and only
+    those not yet known to be uploaded are checked against S3. Datasets updated, or whose product
+    configuration options changing the outputs changed, since their outputs were uploaded are listed
+    until outputs uploaded after the change are found in the bucket, checking --concurrency datasets
+    at a time. Archived datasets are dropped from the catalog.
+
+    With --streaming-diff, the datacube results and the S3 keys are both sorted by output basename in
+    temporary files in the output directory and merge-joined, so memory use stays constant however many
+    keys the S3 list holds.
+
     Uses a configuration file to define the file naming schema.
     """
+    with profile_run(profile_dir, 'generate-work-list', ranks=profile_ranks):
+        _generate_work_list(product_name, output_dir, s3_list, time_range, shards, catalog, s3_bucket_url,
+                            concurrency, streaming_diff, config)
+
+
+def _generate_work_list(product_name, output_dir, s3_list, time_range, shards, catalog, s3_bucket_url,
+                        concurrency, streaming_diff, config):
+    from datacube.ui.expression import parse_expressions
+
+    if catalog is not None and time_range:
+        raise click.BadParameter('A catalog always covers the whole product', param_hint='--time-range')
+    if catalog is not None and streaming_diff:
+        raise click.BadParameter('A catalog only checks its pending datasets', param_hint='--streaming-diff')
+
     with open(config) as config_file:
         config = yaml.safe_load(config_file)['products'][product_name]
 
@@ -182,35 +290,158 @@ def generate_work_list(product_name, output_dir, s3_list, time_range, config):
     else:
         s3_list = Path(s3_list)
 
-    existing_s3_keys = _load_s3_inventory(s3_list)
+    if streaming_diff:
+        if s3_list.suffix == '.dawg':
+            raise click.BadParameter('The S3 list must be a text file', param_hint='--streaming-diff')
+        existing_s3_keys = None
+    else:
+        existing_s3_keys = _load_s3_inventory(s3_list)
 
     # Mapping from Expected Output YAML Location -> Input NetCDF File
     dc_workgen_list = dict()
 
-    eb = expected_bands(product_name)
-
-    for source_uri, new_basename in get_dataset_values(product_name,
-                                                       config,
-                                                       parse_expressions(time_range)):
-        output_yaml = new_basename + '.yaml'
-        expected_outputs = [f'{new_basename}_{band}.tif' for band in eb] + [output_yaml]
-        if not all(output in existing_s3_keys for output in expected_outputs):
-            dc_workgen_list[new_basename] = source_uri.split('file://')[1]
+    eb = expected_bands(product_name, config)
+    suffixes = output_suffixes(eb, multi_band=config.get('multi_band', False))
+
+    def is_uploaded(new_basename):
+        return all(new_basename + suffix in existing_s3_keys for suffix in suffixes)
+
+    if catalog is not None:
+        with ConversionCatalog(catalog) as conversion_catalog:
+            _update_catalog(conversion_catalog, product_name, config)
+
+            conversion_catalog.reprofile(product_name, profile_hash(config), [whole_config_hash(config)])
+
+            uploaded = []
+            # Outputs uploaded before the dataset or the product configuration changed don't count
+            stale = []
+            for source_uri, new_basename, stale_since in conversion_catalog.stale(product_name):
+                if is_uploaded(new_basename):
+                    stale.append((source_uri, new_basename, stale_since))
+                else:
+                    dc_workgen_list[new_basename] = input_from_uri(source_uri)
+            for source_uri, new_basename, uploaded_since in _check_uploaded_since(stale, s3_bucket_url, suffixes,
+                                                                                  concurrency):
+                if uploaded_since:
+                    uploaded.append(source_uri)
+                else:
+                    dc_workgen_list[new_basename] = input_from_uri(source_uri)
+
+            for source_uri, new_basename in conversion_catalog.pending(product_name):
+                if is_uploaded(new_basename):
+                    uploaded.append(source_uri)
+                else:
+                    dc_workgen_list[new_basename] = input_from_uri(source_uri)
+            conversion_catalog.mark_uploaded(uploaded)
+    elif streaming_diff:
+        dataset_values = get_dataset_values(product_name, config, parse_expressions(time_range))
+        with open(s3_list) as s3_keys:
+            missing = merge_diff(external_sort(dataset_lines(dataset_values), tmp_dir=output_dir),
+                                 external_sort(inventory_output_lines(s3_keys, suffixes), tmp_dir=output_dir),
+                                 suffixes)
+            for source_uri, new_basename in missing:
+                dc_workgen_list[new_basename] = input_from_uri(source_uri)
+    else:
+        for source_uri, new_basename in get_dataset_values(product_name,
+                                                           config,
+                                                           parse_expressions(time_range)):
+            if not is_uploaded(new_basename):
+                dc_workgen_list[new_basename] = input_from_uri(source_uri)
 
     out_file = Path(output_dir) / (product_name + TASK_FILE_EXT)
 
-    with open(out_file, 'w', newline='') as fp:
-        csv_writer = csv.writer(fp, quoting=csv.QUOTE_MINIMAL)
-        LOG.info(f'Found {len(dc_workgen_list)} datasets needing conversion, writing to {out_file}')
-        for s3_basename, input_file in dc_workgen_list.items():
-            LOG.debug(f"File does not exists in S3, add to processing list: {input_file}")
-            # Write Input_file, Output Basename
-            csv_writer.writerow((input_file, splitext(s3_basename)[0]))
+    tasks = []
+    for s3_basename, input_file in dc_workgen_list.items():
+        LOG.debug(f"File does not exists in S3, add to processing list: {input_file}")
+        # Input_file, Output Basename, Input Bytes, Pixels per Band, Band Count
+        tasks.append((input_file, splitext(s3_basename)[0], *estimate_task_cost(input_file)))
+
+    LOG.info(f'Found {len(tasks)} datasets needing conversion, writing to {out_file}')
+    _write_task_file(out_file, tasks)
+
+    if shards is not None:
+        for shard_no, shard in enumerate(shard_tasks(tasks, shards, cost=lambda task: task_cost(*task[2:]))):
+            shard_file = Path(output_dir) / f'{product_name}_{shard_no:03d}{TASK_FILE_EXT}'
+            LOG.info(f'Writing {len(shard)} tasks to {shard_file}',
+                     estimated_cost=sum(task_cost(*task[2:]) for task in shard))
+            _write_task_file(shard_file, shard)
 
     if not dc_workgen_list:
         LOG.info(f"No tasks found, everything is up to date.")
 
 
+def _update_catalog(conversion_catalog, product_name, product_config):
+    """
+    Add the datasets of a product added or updated in the datacube since the last update to the catalog
+    """
+    since = conversion_catalog.watermark(product_name)
+    profile = profile_hash(product_config)
+
+    latest = None
+    count = 0
+    for source_uri, new_basename, changed in get_changed_dataset_values(product_name, product_config, since):
+        conversion_catalog.add(product_name, source_uri, new_basename, profile, changed)
+        latest = changed
+        count += 1
+
+    # Archived datasets would otherwise stay pending forever, as they're no longer returned as changed
+    archived = get_archived_dataset_uris(product_name, since)
+    conversion_catalog.remove(archived)
+
+    if latest is not None:
+        conversion_catalog.set_watermark(product_name, latest.isoformat())
+    LOG.info(f'Added {count} new or updated datasets to the catalog, removed {len(archived)} archived ones',
+             since=since)
+
+
+def _check_uploaded_since(stale, s3_bucket_url, suffixes, concurrency):
+    """
+    Check the outputs of many stale datasets concurrently over a shared S3 client
+
+    :param stale: list of ``(uri, basename, stale_since)``
+    :return: generator of ``(uri, basename, whether every output was uploaded since the dataset went stale)``
+    """
+    if not stale:
+        return
+
+    s3 = make_s3_client(max_pool_connections=concurrency)
+
+    def check(source_uri, basename, stale_since):
+        return source_uri, basename, _uploaded_since(s3_bucket_url, basename, suffixes, stale_since, s3)
+
+    # At most a few datasets per worker are queued at once
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set()
+        for row in stale:
+            pending.add(executor.submit(check, *row))
+            if len(pending) >= 4 * concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        for future in pending:
+            yield future.result()
+
+    LOG.info('Checked the outputs of stale datasets on S3', datasets=len(stale), requests_per_dataset=len(suffixes))
+
+
+def _uploaded_since(s3_bucket_url, basename, suffixes, since, s3):
+    """
+    Whether every output of a dataset was uploaded after a point in time, in seconds since the epoch
+    """
+    for suffix in suffixes:
+        last_modified = s3_last_modified(f'{s3_bucket_url.rstrip("/")}/{basename}{suffix}', s3=s3)
+        if last_modified is None or last_modified.timestamp() < since:
+            return False
+    return True
+
+
+def _write_task_file(out_file, tasks):
+    with open(out_file, 'w', newline='') as fp:
+        csv_writer = csv.writer(fp, quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerows(tasks)
+
+
 def _load_s3_inventory(s3_list):
     if s3_list.suffix == '.dawg':
         import dawg
@@ -227,27 +458,60 @@ def _load_s3_inventory(s3_list):
 @product_option
 @output_dir_option
 @config_file_option
+@click.option('--metadata-only', is_flag=True, default=False,
+              help='Only regenerate the dataset YAML files, overwriting existing ones, without reading raster data')
+@click.option('--retries', type=click.IntRange(min=0), default=2, show_default=True,
+              help='Number of times failed tasks are retried at the end of each worker\'s queue')
+@click.option('--retry-delay', type=click.FloatRange(min=0), default=10., show_default=True,
+              help='Seconds to wait before the first retry, doubled for each further retry')
+@profile_option
+@profile_ranks_option
+@click.option('--profile-every', type=click.IntRange(min=1), default=1, show_default=True,
+              help='With --profile, only sample one in every N tasks of each rank')
 @click.argument('filelist', nargs=1, required=True)
-def mpi_convert(product_name, output_dir, config, filelist):
+def mpi_convert(product_name, output_dir, config, metadata_only, retries, retry_delay,
+                profile_dir, profile_ranks, profile_every, filelist):
     """
     Iterate over the file list and assign MPI worker for processing.
-    Split the input file by the number of workers, each MPI worker completes every nth task.
+    Split the input file by the number of workers, each MPI worker completes a contiguous slice of the tasks,
+    with all the time slices of an input file in the same slice.
     Also, detect and fail early if not using full resources in an MPI job.
 
+    Use --metadata-only to rewrite the YAML documents of already converted datasets, eg. when
+    band paths or lineage rules change.
+
+    Tasks which fail are retried with a growing delay once the rest of the queue is done.
+    Those still failing are written to failed_tasks.csv in the output directory, in the task
+    file format, so they can be re-run on their own.
+
+    With --profile, the conversion of every --profile-every'th task of each rank is sampled.
+
     \b
     Before using this command, execute the following:
       $ module use /g/data/v10/public/modules/modulefiles/
       $ module load dea
       $ module load openmpi/3.1.4
     """
+    with profile_run(profile_dir, 'mpi-convert', ranks=profile_ranks, sample_whole_run=False) as sampler:
+        _mpi_convert(product_name, output_dir, config, metadata_only, retries, retry_delay, filelist,
+                     sampler, profile_every)
+
+
+def _mpi_convert(product_name, output_dir, config, metadata_only, retries, retry_delay, filelist,
+                 sampler, profile_every):
+    from dea_cogger.cogeo import DEFAULT_GDAL_CONFIG, COGException, ConversionContext
+
     job_rank, job_size = _mpi_init()
 
+    # Share the node's cores and memory between the ranks running on it
+    apply_resource_plan(DEFAULT_GDAL_CONFIG)
+
     with open(config) as cfg_file:
         config = yaml.safe_load(cfg_file)
 
     try:
-        fl = open(filelist)
-        tasks = csv.reader(fl)
+        with open(filelist, newline='') as fl:
+            tasks = list(csv.reader(fl))
     except FileNotFoundError:
         LOG.error('Task file not found.', filepath=filelist)
         sys.exit(1)
@@ -256,42 +520,124 @@ def mpi_convert(product_name, output_dir, config, filelist):
 
     product_config = config['products'][product_name]
 
-    for i, (in_filepath, s3_dirsuffix) in enumerate(tasks):
-        if i % job_size == job_rank:
+    # Reuse one GDAL environment, the product's converter and open source datasets across the tasks of this rank
+    with ConversionContext(DEFAULT_GDAL_CONFIG) as context:
+        def run_task(in_filepath, s3_dirsuffix, profile=False):
+            if profile:
+                sampler.start()
+            start_time = time.perf_counter()
             try:
                 _convert_cog(product_config, in_filepath,
-                             Path(output_dir) / s3_dirsuffix.strip())
-                LOG.info(f'Successfully converted', filepath=in_filepath)
-            except Exception:
-                LOG.exception('Unable to convert', filepath=in_filepath)
+                             Path(output_dir) / s3_dirsuffix.strip(),
+                             metadata_only=metadata_only,
+                             context=context)
+                LOG.info(f'Successfully converted', filepath=in_filepath,
+                         seconds=round(time.perf_counter() - start_time, 3))
+            except Exception as exc:
+                LOG.exception('Unable to convert', filepath=in_filepath,
+                              seconds=round(time.perf_counter() - start_time, 3))
+                # Don't reuse source datasets left in an unknown state
+                context.datasets.close()
+                return exc
+            finally:
+                if profile:
+                    sampler.stop()
+
+        # Ledger of failed tasks, as (input file, output basename, error class)
+        failed_tasks = []
+
+        # Task files may carry extra columns after the input file and output basename, eg. estimated costs
+        for i, (in_filepath, s3_dirsuffix, *_) in enumerate(tasks_of_rank(tasks, job_rank, job_size)):
+            profile = sampler is not None and i % profile_every == 0
+            error = run_task(in_filepath, s3_dirsuffix, profile=profile)
+            if error is not None:
+                failed_tasks.append((in_filepath, s3_dirsuffix, type(error).__name__))
+
+        for attempt in range(retries):
+            # Bad inputs or existing outputs won't fix themselves, only retry the other errors
+            retryable = [task for task in failed_tasks if task[2] != COGException.__name__]
+            if not retryable:
+                break
+
+            delay = min(retry_delay * 2 ** attempt, MAX_RETRY_DELAY)
+            LOG.info('Retrying failed tasks', attempt=attempt + 1, tasks=len(retryable), delay=delay)
+            time.sleep(delay)
+
+            failed_tasks = [task for task in failed_tasks if task[2] == COGException.__name__]
+            for in_filepath, s3_dirsuffix, _ in retryable:
+                error = run_task(in_filepath, s3_dirsuffix)
+                if error is not None:
+                    failed_tasks.append((in_filepath, s3_dirsuffix, type(error).__name__))
+
+    if job_size > 1:
+        from mpi4py import MPI
+        gathered = MPI.COMM_WORLD.gather(failed_tasks, root=0)
+        if job_rank != 0:
+            return
+        failed_tasks = [task for rank_tasks in gathered for task in rank_tasks]
+
+    failed_file = Path(output_dir) / FAILED_TASKS_FILE
+    if failed_tasks:
+        LOG.error(f'{len(failed_tasks)} tasks failed, writing them to {failed_file}',
+                  error_classes=sorted(set(error_class for _, _, error_class in failed_tasks)))
+    _write_task_file(failed_file, failed_tasks)
 
 
 @cli.command(name='verify',
              help="Verify GeoTIFFs are Cloud Optimised GeoTIFF")
-@click.argument('path', type=click.Path(exists=True))
+@click.argument('path')
 @click.option('--rm-broken', type=bool, default=False, is_flag=True,
               help="Remove directories with broken files")
-def verify(path, rm_broken):
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=None,
+              help="Number of local worker processes when not running under MPI (default: number of CPUs)")
+@click.option('--cache', type=click.Path(dir_okay=False), default=None,
+              help="File recording verified GeoTIFFs by path, size and mtime, so repeat runs only check new or "
+                   "changed files")
+@click.option('--s3', 'remote', type=bool, default=False, is_flag=True,
+              help="PATH is an S3 URL prefix, check the GeoTIFFs listed under it in the S3 inventory with ranged reads")
+@s3_inv_option
+@click.option('--concurrency', type=click.IntRange(min=1), default=32, show_default=True,
+              help="Number of S3 objects checked concurrently with --s3")
+@profile_option
+@profile_ranks_option
+def verify(path, rm_broken, jobs, cache, remote, inventory_manifest, concurrency, profile_dir, profile_ranks):
     """
     Verify converted GeoTIFF files are (Geo)TIFF with cloud optimized compatible structure.
 
     Optionally delete any directories (and their content) that contain broken GeoTIFFs
 
-    PATH may be either a directory to recursively check, or a file with a list of filenames to check
+    PATH may be either a directory to recursively check, or a file with a list of filenames to check.
+    With --s3, PATH is an S3 URL prefix, eg. s3://dea-public-data/WOfS/WOFLs/v2.1.5/combined/
+
+    With --profile, only the main process is sampled, use --jobs 1 to include the validation itself.
     """
+    with profile_run(profile_dir, 'verify', ranks=profile_ranks):
+        _verify(path, rm_broken, jobs, cache, remote, inventory_manifest, concurrency)
+
+
+def _verify(path, rm_broken, jobs, cache, remote, inventory_manifest, concurrency):
+    if remote:
+        if rm_broken:
+            raise click.BadParameter('Broken files can only be removed from a local PATH', param_hint='--rm-broken')
+        _verify_s3(path, inventory_manifest, concurrency)
+        return
+
+    if not Path(path).exists():
+        raise click.BadParameter(f'Path "{path}" does not exist.', param_hint='PATH')
+
     job_rank, job_size = _mpi_init()
     broken_files = set()
+    verified_cache = VerifiedCache(cache)
 
     path = Path(path)
 
     if path.is_dir():
-        # Non-lazy recursive search for geotiffs
-        gtiff_file_list = Path(path).rglob("*.[tT][iI][fF]")
-        gtiff_file_list = list(gtiff_file_list)
+        # Lazy recursive search for geotiffs
+        gtiff_files = iter_geotiffs(path)
     else:
         # Read filenames to check from a file
         with path.open() as fin:
-            gtiff_file_list = [line.strip() for line in fin]
+            gtiff_files = iter_listed_geotiffs([line.strip() for line in fin])
 
     if job_size == 1 and sys.stdout.isatty():
         # Not running in parallel, display a TQDM progress bar
@@ -302,43 +648,85 @@ def verify(path, rm_broken):
         # Running in parallel, only process every nth file
         iter_wrapper = nth_by_mpi
 
-    for geotiff_file in iter_wrapper(gtiff_file_list):
-        # TODO: Call directly instead of instanciating more python interpreters!
-        command = f"python3 {VALIDATE_GEOTIFF_CMD} {geotiff_file}"
-        exitcode, output = subprocess.getstatusoutput(command)
-        validator_output = output.split('/')[-1]
-
-        # If no metadata file does not exists after cog conversion then add the tiff file to the broken files set
-        if not list(geotiff_file.parent.rglob('*.yaml')):
-            LOG.error("No YAML file created for GeoTIFF file", error=validator_output, filename=geotiff_file)
-            broken_files.add(geotiff_file)
+    def needs_validating():
+        for geotiff_file, has_yaml in iter_wrapper(gtiff_files):
+            # If no metadata file does not exists after cog conversion then add the tiff file to the broken files set
+            if not has_yaml:
+                LOG.error("No YAML file created for GeoTIFF file", filename=geotiff_file)
+                broken_files.add(geotiff_file)
+            elif geotiff_file in verified_cache:
+                LOG.debug('Already verified', filename=geotiff_file)
+            else:
+                yield geotiff_file
+
+    if job_size == 1 and jobs != 1:
+        # Not running under MPI, validate with a local pool of processes instead
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(validate_geotiff, needs_validating(), chunksize=8)
+    else:
+        pool = None
+        results = (validate_geotiff(geotiff_file) for geotiff_file in needs_validating())
 
-        if exitcode == 0:
-            LOG.debug(validator_output)
-        else:
+    for geotiff_file, errors in results:
+        if errors:
             # Log and remember broken COG
-            LOG.error("Invalid GeoTIFF file", error=validator_output, filename=geotiff_file)
+            LOG.error("Invalid GeoTIFF file", error=errors, filename=geotiff_file)
             broken_files.add(geotiff_file)
+        else:
+            LOG.debug('Valid GeoTIFF file', filename=geotiff_file)
+            verified_cache.add(geotiff_file)
 
-    if rm_broken:
-        # Delete directories containing broken files
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if job_size > 1:
+        # Gather everything on the first rank, only it writes the cache and deletes directories.
         # Prevent deleting directories out from under another worker that's checking files within.
         from mpi4py import MPI
         comm = MPI.COMM_WORLD
 
-        gathered = comm.gather(broken_files, root=0)
-        if job_rank == 0:
-            broken_files = set().union(*gathered)
-        else:
+        gathered = comm.gather((broken_files, verified_cache.new_entries), root=0)
+        if job_rank != 0:
             assert gathered is None
             return
+        broken_files = set().union(*(broken for broken, _ in gathered))
+        verified_cache.save([entry for _, entries in gathered for entry in entries])
+    else:
+        verified_cache.save()
 
+    if rm_broken:
+        # Delete directories containing broken files
         broken_directories = set(file.parent for file in broken_files)
 
         for directory in broken_directories:
+            if not directory.exists():
+                continue
             LOG.info('Deleting directory', dir=directory)
             shutil.rmtree(directory)
 
 
+def _verify_s3(s3_url, inventory_manifest, concurrency):
+    """
+    Check the COG structure of the GeoTIFFs under an S3 prefix, fetching only the leading bytes of each
+    """
+    bucket, prefix = _s3_url_parse(s3_url)
+    s3 = make_s3_client(max_pool_connections=concurrency)
+
+    geotiff_urls = (f's3://{bucket}/{rec.Key}' for rec in list_inventory(inventory_manifest, s3=s3)
+                    if rec.Key.startswith(prefix) and rec.Key.lower().endswith(('.tif', '.tiff')))
+
+    checked = broken = 0
+    for url, errors in validate_remote_geotiffs(geotiff_urls, s3, concurrency=concurrency):
+        checked += 1
+        if errors:
+            broken += 1
+            LOG.error("Invalid GeoTIFF object", error=errors, url=url)
+        else:
+            LOG.debug('Valid GeoTIFF object', url=url)
+
+    LOG.info('Checked remote GeoTIFFs', prefix=s3_url, checked=checked, broken=broken)
+
+
 if __name__ == '__main__':
     cli()
@@ -1,20 +1,29 @@
 """rio_cogeo.cogeo: translate a file to a cloud optimized geotiff."""
+import json
 import os
 import re
+import uuid
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 from typing import Union
+from xml.sax.saxutils import escape
 
 import gdal
+import gdal_array
 import numpy
 import rasterio
 import structlog
 import xarray
 import yaml
 from rasterio.enums import Resampling
-from rasterio.io import MemoryFile
-from rasterio.shutil import copy
+from rasterio.windows import Window
 from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
 
+from dea_cogger.overviews import OverviewPyramid, overview_factors
+from dea_cogger.statistics import BandStatistics
+from dea_cogger.utils import vsi_path
+
 DEFAULT_GDAL_CONFIG = {'NUM_THREADS': 1, 'GDAL_TIFF_OVR_BLOCKSIZE': 512}
 # Note: DEFLATE compression while more efficient than LZW can cause compatibility issues
 #       with some software packages
@@ -30,31 +39,76 @@ DEFAULT_PROFILE = {'driver': 'GTiff',
                    'zlevel': 9}
 LOG = structlog.get_logger()
 
+# Source datasets kept open by a `DatasetCache`, enough for an input file and every one of its bands, so the
+# bands of the next time slice of a stacked file are still open
+MAX_OPEN_DATASETS = 64
+
+# Memory for the block caches of all the remote inputs open at once
+VSI_CACHE_BYTES = 256 * 1024 * 1024
+
 # GDAL Initialisation
 os.environ['GDAL_DISABLE_READDIR_ON_OPEN'] = 'YES'
-os.environ['CPL_VSIL_CURL_ALLOWED_EXTENSIONS'] = '.tif'
+os.environ['CPL_VSIL_CURL_ALLOWED_EXTENSIONS'] = '.tif,.nc'
+# Remote inputs are read with ranged requests, through an in-memory LRU cache of blocks of each open file
+# and a process wide one of the downloaded ranges. Any of these can be overridden from the environment.
+# The per file cache is sized so that the most files a `DatasetCache` keeps open share VSI_CACHE_BYTES.
+os.environ.setdefault('VSI_CACHE', 'TRUE')
+os.environ.setdefault('VSI_CACHE_SIZE', str(VSI_CACHE_BYTES // MAX_OPEN_DATASETS))
+os.environ.setdefault('CPL_VSIL_CURL_CACHE_SIZE', str(256 * 1024 * 1024))
 gdal.UseExceptions()
 
+try:
+    # Only used to size the netCDF/HDF5 chunk cache, which GDAL's netCDF driver shares
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
 
 class COGException(Exception):
     pass
 
 
+class BandSelection:
+    """
+    Decide which bands of a product are converted, from its black and white lists of band name regexes
+
+    The expressions are compiled once, and the same selection is used for the GeoTIFFs, the
+    dataset YAML and the list of outputs expected on S3.
+    """
+
+    def __init__(self, black_list=None, white_list=None):
+        self.black_list = self._compile(black_list)
+        self.white_list = self._compile(white_list)
+
+    @staticmethod
+    def _compile(patterns):
+        if patterns is None:
+            return None
+        if not isinstance(patterns, str):
+            patterns = '|'.join(f'(?:{pattern})' for pattern in patterns)
+        return re.compile(patterns)
+
+    def __call__(self, band_name):
+        if self.black_list is not None and self.black_list.search(band_name) is not None:
+            return False
+        if self.white_list is not None and self.white_list.search(band_name) is None:
+            return False
+        return True
+
+
 class NetCDFCOGConverter:
     """
     Convert the input files to COG style GeoTIFFs
     """
 
     def __init__(self, black_list=None, white_list=None, no_overviews=None, default_resampling='average',
-                 bands_rsp=None, name_template=None, prefix=None, predictor=2):
+                 bands_rsp=None, name_template=None, prefix=None, predictor=2, sparse=False, engine='gtiff',
+                 byte_nodata=None, multi_band=False, datasets=None):
         # A list of keywords of bands which don't require resampling
         self.no_overviews = no_overviews if no_overviews is not None else []
 
-        # A list of keywords of bands excluded in cog convert
-        self.black_list = black_list
-
-        # A list of keywords of bands to be converted
-        self.white_list = white_list
+        # Keywords of bands excluded from, or to be included in, the cog convert
+        self.band_selection = BandSelection(black_list, white_list)
 
         self.bands_rsp = bands_rsp if bands_rsp is not None else {}
         self.name_template = name_template
@@ -64,17 +118,41 @@ class NetCDFCOGConverter:
 
         self.default_resampling = default_resampling
 
-    def __call__(self, input_fname, output_prefix):
+        # Leave blocks which are entirely nodata out of the GeoTIFFs
+        self.sparse = sparse
+
+        # Either 'gtiff', writing through an intermediate GeoTIFF, or 'cog' for GDAL's COG driver
+        if engine not in COG_ENGINES:
+            raise COGException(f'Unknown COG engine {engine}, expected one of {sorted(COG_ENGINES)}')
+        self.engine = engine
+
+        # Nodata value for Byte bands with a negative nodata, which are otherwise widened to int16
+        if byte_nodata is not None and not 0 <= byte_nodata <= 255:
+            raise COGException(f'byte_nodata must be between 0 and 255, not {byte_nodata}')
+        self.byte_nodata = byte_nodata
+
+        # Write all the bands of a dataset to a single GeoTIFF, instead of one per band
+        if multi_band and engine == 'cog':
+            raise COGException('The COG engine writes pixel interleaved GeoTIFFs, use the gtiff engine for multi_band')
+        self.multi_band = multi_band
+
+        # Optional `DatasetCache` of open source datasets, shared between conversions
+        self.datasets = datasets
+
+    def __call__(self, input_fname, output_prefix, metadata_only=False):
         Path(output_prefix).parent.mkdir(parents=True, exist_ok=True)
-        self.generate_cog_files(input_fname, output_prefix)
+        self.generate_cog_files(input_fname, output_prefix, metadata_only=metadata_only)
 
-    def generate_cog_files(self, input_file, output_prefix):
+    def generate_cog_files(self, input_file, output_prefix, metadata_only=False):
         """
         Convert the datasets from the input file to COG format and save them in the 'dest_dir'
 
         Each dataset is put in a separate directory.
 
         The directory names will look like 'LS_WATER_3577_9_-39_20180506102018'
+
+        With `metadata_only`, only the dataset YAML is (re)generated, overwriting any existing one,
+        and no raster data is read.
         """
 
         # Extract the #part=?? number if it exists in the filename, as used by ODC
@@ -87,6 +165,17 @@ class NetCDFCOGConverter:
         if not Path(input_file).match("*.[nN][cC]"):
             raise COGException("COG Converter only works with NetCDF datasets.")
 
+        # Read remote files with ranged requests, only the parts of the selected bands are fetched
+        input_file = vsi_path(input_file)
+
+        # Only the time slices of the same file, read one after the other, reuse open datasets
+        if self.datasets is not None:
+            self.datasets.retain(input_file)
+
+        if metadata_only:
+            self._netcdf_to_yaml(input_file, part_index, output_prefix)
+            return
+
         yaml_fname = output_prefix.with_suffix('.yaml')
 
         if yaml_fname.exists():
@@ -105,34 +194,39 @@ class NetCDFCOGConverter:
 
         yaml_fname = output_prefix.with_suffix('.yaml')
 
-        dataset_array = xarray.open_dataset(input_file)
-        if len(dataset_array.dataset) == 1:
-            dataset_object = dataset_array.dataset.item().decode('utf-8')
-        else:
-            dataset_object = dataset_array.dataset.isel(time=part_index).item().decode('utf-8')
-
-        dataset = yaml.load(dataset_object, Loader=Loader)
+        dataset = yaml.load(_read_dataset_doc(input_file, part_index), Loader=Loader)
         if dataset is None:
             LOG.info(f'No YAML section {output_prefix}')
             return
 
+        if self.multi_band:
+            # Band numbers within the single GeoTIFF, in the order they're written
+            band_numbers = {band_name: band_no
+                            for band_no, (band_name, _) in enumerate(self._selected_bands(input_file), start=1)}
+
         invalid_band = []
         # Update band urls
         for band_name, band_definition in dataset['image']['bands'].items():
-            if self.black_list is not None:
-                if re.search(self.black_list, band_name) is not None:
-                    invalid_band.append(band_name)
-                    continue
-
-            if self.white_list is not None:
-                if re.search(self.white_list, band_name) is None:
-                    invalid_band.append(band_name)
-                    continue
-
-            tif_path = f'{output_prefix.name}_{band_name}.tif'
+            if not self.band_selection(band_name):
+                invalid_band.append(band_name)
+                continue
 
             band_definition.pop('layer', None)
-            band_definition['path'] = tif_path
+            if self.multi_band:
+                if band_name not in band_numbers:
+                    raise COGException(f'Band {band_name} of the dataset document is not a NetCDF variable '
+                                       f'of {input_file}, so it has no band in the multi band GeoTIFF')
+                band_definition['path'] = f'{output_prefix.name}.tif'
+                band_definition['band'] = band_numbers[band_name]
+            else:
+                band_definition['path'] = f'{output_prefix.name}_{band_name}.tif'
+
+            if self.byte_nodata is not None:
+                # Only the header is read, so this also works without converting the pixels
+                nodata_mask, nodata, _ = _nodata_mask(f'NETCDF:"{input_file}":{band_name}', self.byte_nodata,
+                                                      self.datasets)
+                if nodata_mask is not None:
+                    band_definition['nodata'] = nodata
 
         for band in invalid_band:
             dataset['image']['bands'].pop(band, None)
@@ -144,29 +238,48 @@ class NetCDFCOGConverter:
             yaml.dump(dataset, fp, default_flow_style=False, Dumper=Dumper)
             LOG.info(f"Created yaml file, {yaml_fname}")
 
-    def _netcdf_to_cogs(self, input_file, part_index, output_prefix):
+    def _selected_bands(self, input_file):
         """
-        Write the datasets to separate cog files
+        Return ``(band_name, subdataset_name)`` of the bands of the input file selected for conversion
         """
         try:
-            dataset = gdal.Open(input_file, gdal.GA_ReadOnly)
+            dataset = _gdal_open(input_file, self.datasets)
         except Exception as exp:
             LOG.exception(f"GDAL input file error {input_file}: \n{exp}")
-            return
+            return []
 
         if dataset is None:
-            return
+            return []
 
         subdatasets = dataset.GetSubDatasets()
 
-        profile = DEFAULT_PROFILE.copy()
-        profile['predictor'] = self.predictor
-
+        bands = []
         for dts in subdatasets[:-1]:  # Skip the last dataset, since that is the metadata doc
 
             # Band Name is the last of the colon separate elements in GDAL
             band_name = dts[0].split(':')[-1]
 
+            # Never read excluded bands
+            if self.band_selection(band_name):
+                bands.append((band_name, dts[0]))
+        return bands
+
+    def _netcdf_to_cogs(self, input_file, part_index, output_prefix):
+        """
+        Write the datasets to separate cog files
+        """
+        bands = self._selected_bands(input_file)
+
+        profile = DEFAULT_PROFILE.copy()
+        profile['predictor'] = self.predictor
+        if self.sparse:
+            profile['sparse_ok'] = True
+
+        if self.multi_band:
+            self._netcdf_to_multi_band_cog(bands, part_index, output_prefix, profile)
+            return
+
+        for band_name, subdataset in bands:
             out_fname = output_prefix.parent / f'{output_prefix.name}_{band_name}.tif'
 
             # Check the done files might need a force option later
@@ -180,16 +293,56 @@ class NetCDFCOGConverter:
             if band_name in self.no_overviews:
                 resampling_method = None
 
-            cog_translate(dts[0], str(out_fname),
-                          profile,
-                          indexes=[part_index + 1],
-                          overview_resampling=resampling_method,
-                          config=DEFAULT_GDAL_CONFIG)
+            COG_ENGINES[self.engine](subdataset, str(out_fname),
+                                     profile,
+                                     indexes=[part_index + 1],
+                                     overview_resampling=resampling_method,
+                                     config=DEFAULT_GDAL_CONFIG,
+                                     sparse=self.sparse,
+                                     byte_nodata=self.byte_nodata,
+                                     datasets=self.datasets)
+
+    def _netcdf_to_multi_band_cog(self, bands, part_index, output_prefix, profile):
+        """
+        Write all the selected bands to a single band interleaved cog file, in one pass over the blocks
+        """
+        out_fname = output_prefix.parent / f'{output_prefix.name}.tif'
+
+        if out_fname.exists():
+            if self._check_tif(out_fname):
+                return
+
+        # Bands without overviews get the cheapest resampling, unless none of the bands have overviews
+        resampling_methods = [None if band_name in self.no_overviews
+                              else self.bands_rsp.get(band_name, self.default_resampling)
+                              for band_name, _ in bands]
+        if all(method is None for method in resampling_methods):
+            resampling_methods = None
+        else:
+            resampling_methods = [method or 'nearest' for method in resampling_methods]
+
+        vrt_fname = output_prefix.parent / f'{output_prefix.name}.vrt'
+        _stack_bands(str(vrt_fname), [subdataset for _, subdataset in bands], part_index + 1, self.datasets)
+        try:
+            COG_ENGINES[self.engine](str(vrt_fname), str(out_fname),
+                                     dict(profile, interleave='band'),
+                                     overview_resampling=resampling_methods,
+                                     config=DEFAULT_GDAL_CONFIG,
+                                     sparse=self.sparse,
+                                     byte_nodata=self.byte_nodata,
+                                     datasets=self.datasets)
+        finally:
+            # The VRT is written again for the next time slice, don't keep it open
+            if self.datasets is not None:
+                self.datasets.discard(str(vrt_fname))
+            if vrt_fname.exists():
+                vrt_fname.unlink()
 
     def _check_tif(self, fname):
         try:
             cog_tif = gdal.Open(str(fname), gdal.GA_ReadOnly)
             srcband = cog_tif.GetRasterBand(1)
+            # Read back from the STATISTICS_* metadata stored while writing, without a pass over the pixels
             t_stats = srcband.GetStatistics(True, True)
         except Exception:
             LOG.exception(f"Exception opening {fname}")
@@ -201,18 +354,155 @@ class NetCDFCOGConverter:
             return False
 
 
+class DatasetCache:
+    """
+    Small LRU cache of open source datasets, for bands and consecutive tasks reading the same NetCDF file
+
+    The datasets are owned by the cache, and closed when they're evicted, when a task reads another
+    input file, or when the cache is closed.
+    """
+
+    def __init__(self, max_size=MAX_OPEN_DATASETS):
+        self.max_size = max_size
+        self.datasets = OrderedDict()
+
+    def _get(self, key, opener):
+        if key in self.datasets:
+            self.datasets.move_to_end(key)
+            return self.datasets[key]
+
+        dataset = self.datasets[key] = opener()
+        while len(self.datasets) > self.max_size:
+            _, evicted = self.datasets.popitem(last=False)
+            _close_dataset(evicted)
+        return dataset
+
+    def gdal_open(self, path):
+        return self._get(('gdal', path), lambda: gdal.Open(path, gdal.GA_ReadOnly))
+
+    def rasterio_open(self, path):
+        return self._get(('rasterio', path), lambda: rasterio.open(path))
+
+    def retain(self, input_file):
+        """
+        Close the datasets of every input file but `input_file`, and of its subdatasets
+        """
+        for key in [key for key in self.datasets if _source_file(key[1]) != input_file]:
+            _close_dataset(self.datasets.pop(key))
+
+    def discard(self, path):
+        """
+        Close the datasets opened from `path`, eg. a temporary file about to be removed
+        """
+        for key in [key for key in self.datasets if key[1] == path]:
+            _close_dataset(self.datasets.pop(key))
+
+    def close(self):
+        for dataset in self.datasets.values():
+            _close_dataset(dataset)
+        self.datasets.clear()
+
+
+class ConversionContext:
+    """
+    Long lived state of a process converting many datasets, eg. an MPI rank
+
+    Keeps one rasterio/GDAL environment active, a converter per product configuration, and a
+    `DatasetCache` of open source datasets, instead of setting them up again for every task.
+    While a context is active, its GDAL config applies to every conversion, whatever config they're given.
+    """
+
+    # The context entered, if any
+    active = None
+
+    def __init__(self, config=None, max_open_datasets=MAX_OPEN_DATASETS):
+        self.config = config if config is not None else DEFAULT_GDAL_CONFIG
+        self.datasets = DatasetCache(max_open_datasets)
+        self.converters = {}
+        self._env = None
+
+    def __enter__(self):
+        self._env = ExitStack()
+        self._env.enter_context(rasterio.Env(**self.config))
+        self._env.enter_context(_gdal_config_options(self.config))
+        ConversionContext.active = self
+        return self
+
+    def __exit__(self, *exc_info):
+        ConversionContext.active = None
+        self.datasets.close()
+        self._env.__exit__(*exc_info)
+
+    def converter(self, product_config):
+        """
+        Return the converter of a product configuration, creating it on first use
+        """
+        key = json.dumps(product_config, sort_keys=True, default=str)
+        if key not in self.converters:
+            self.converters[key] = NetCDFCOGConverter(datasets=self.datasets, **product_config)
+        return self.converters[key]
+
+
+def _read_dataset_doc(input_file, part_index):
+    """
+    Return the embedded ODC dataset document for one time index of a NetCDF file
+
+    Reads only the ``dataset`` variable, and only the requested time slice, through the low level
+    netCDF4 library when it's available. Otherwise fall back to xarray, which decodes every
+    coordinate and variable in the file. Remote files are read through GDAL's virtual file systems.
+    """
+    if input_file.startswith('/vsi'):
+        return _read_remote_dataset_doc(input_file, part_index)
+
+    if netCDF4 is None:
+        dataset_array = xarray.open_dataset(input_file)
+        if len(dataset_array.dataset) == 1:
+            return dataset_array.dataset.item().decode('utf-8')
+        return dataset_array.dataset.isel(time=part_index).item().decode('utf-8')
+
+    with netCDF4.Dataset(input_file) as nco:
+        variable = nco.variables['dataset']
+        variable.set_auto_chartostring(False)
+        variable.set_auto_maskandscale(False)
+
+        if variable.ndim > 1 and variable.shape[0] > 1:
+            chars = variable[part_index]
+        elif variable.ndim > 1:
+            chars = variable[0]
+        else:
+            chars = variable[:]
+
+    return numpy.ma.getdata(chars).tobytes().rstrip(b'\x00').decode('utf-8')
+
+
+def _read_remote_dataset_doc(input_file, part_index):
+    """
+    Read the ``dataset`` variable, exposed by GDAL as a raster of one row of characters per time index
+    """
+    chars = gdal.Open(f'NETCDF:"{input_file}":dataset', gdal.GA_ReadOnly).ReadAsArray()
+    if chars.ndim > 1:
+        chars = chars[part_index] if chars.shape[0] > 1 else chars[0]
+    return chars.tobytes().rstrip(b'\x00').decode('utf-8')
+
+
 def cog_translate(
         src_path,
         dst_path,
         dst_kwargs,
         indexes=None,
-        overview_level=5,
+        overview_level=None,
         overview_resampling=None,
         config=None,
+        sparse=False,
+        byte_nodata=None,
+        datasets=None,
 ):
     """
     Create Cloud Optimized Geotiff.
 
+    Band statistics are accumulated from the blocks as they're written and stored in the
+    output, see `dea_cogger.statistics`.
+
     Parameters
     ----------
     src_path : str or PathLike object
@@ -224,26 +514,33 @@ def cog_translate(
         output dataset creation options.
     indexes : tuple, int, optional
         Raster band indexes to copy.
-    overview_level : int, optional (default: 6)
-        COGEO overview (decimation) level
+    overview_level : int, optional
+        COGEO overview (decimation) level. By default, levels are added until the
+        smallest overview fits in a single block.
     overview_resampling : str, [average, nearest, mode]
+        Overviews are built from the full resolution blocks while they are written,
+        see `dea_cogger.overviews`.
     config : dict
-        Rasterio Env options.
+        GDAL config options, for rasterio and the GDAL bindings. Ignored within a
+        `ConversionContext`, whose own config is already applied.
+    sparse : bool
+        Don't write blocks which are entirely nodata (or zero, without nodata), readers see
+        the nodata value for them. `dst_kwargs` should include ``sparse_ok=True``.
+    byte_nodata : int, optional
+        Keep Byte bands with a negative nodata as Byte, using this nodata value instead of
+        widening them to int16.
+    datasets : DatasetCache, optional
+        Cache of open source datasets to read from, instead of opening and closing the source.
 
     """
     config = config or {}
 
-    nodata_mask = None
-    src = gdal.Open(src_path, gdal.GA_ReadOnly)
-    band = src.GetRasterBand(1)
-    nodata = band.GetNoDataValue()
-
-    # Update nodata mask only if nodata is a negative integer value
-    if band.DataType == gdal.GDT_Byte and nodata and nodata < 0:
-        nodata_mask = 255
+    nodata_mask, nodata, dtype = _nodata_mask(src_path, byte_nodata, datasets)
 
-    with rasterio.Env(**config):
-        with rasterio.open(src_path) as src:
+    # Only the source is read with rasterio. The intermediate GeoTIFF is created, filled, given its overviews
+    # and copied with GDAL alone, as a rasterio wheel links its own libgdal, which can't open GDAL's /vsimem files.
+    with _conversion_env(config):
+        with _open_source(src_path, datasets) as src:
 
             indexes = indexes if indexes else src.indexes
             meta = src.meta
@@ -255,31 +552,447 @@ def cog_translate(
             meta.pop("photometric", None)
             if nodata_mask is not None:
                 meta['nodata'] = nodata
-                meta['dtype'] = 'int16'
-            meta['stats'] = True
-
-            with MemoryFile() as memfile:
-                with memfile.open(**meta) as mem:
-                    wind = list(mem.block_windows(1))
-                    for ij, w in wind:
-                        matrix = src.read(window=w, indexes=indexes)
-                        if nodata_mask is not None:
-                            matrix = numpy.array(matrix, dtype='int16')
-                            matrix[matrix == nodata_mask] = nodata
-
-                        mem.write(matrix, window=w)
-
-                    if overview_resampling is not None:
-                        overviews = [2 ** j for j in range(1, overview_level + 1)]
-
-                        mem.build_overviews(overviews, Resampling[overview_resampling])
-                        mem.update_tags(
-                            OVR_RESAMPLING_ALG=Resampling[overview_resampling].name.upper()
-                        )
-
-                    try:
-                        copy(mem, dst_path, **dst_kwargs)
-                        LOG.info(f"Created a cloud optimized GeoTIFF file, {dst_path}")
-                    except Exception:
-                        LOG.exception(f"Error while creating a cloud optimized GeoTIFF file, {dst_path}")
-                        raise
+                meta['dtype'] = dtype
+
+            statistics = BandStatistics(meta['count'], nodata=meta['nodata'],
+                                        total_pixels=meta['width'] * meta['height'])
+
+            pyramid = None
+            if overview_resampling is not None:
+                factors = overview_factors(meta['width'], meta['height'], meta.get('blockxsize', 512), overview_level)
+                pyramid = OverviewPyramid(meta['width'], meta['height'], meta['count'], meta['dtype'],
+                                          factors, overview_resampling, nodata=meta['nodata'])
+
+            tmp_path = f'/vsimem/{uuid.uuid4().hex}.tif'
+            mem = _create_intermediate(tmp_path, meta)
+            try:
+                empty_blocks = 0
+                _check_chunk_cache(src, len(indexes))
+                windows = _block_windows(meta['width'], meta['height'],
+                                         meta.get('blockxsize', 512), meta.get('blockysize', 512))
+                for w, matrix in _chunk_aligned_blocks(src, windows, indexes):
+                    if nodata_mask is not None:
+                        matrix = _apply_nodata_mask(matrix, nodata_mask, nodata, dtype)
+
+                    statistics.add_block(matrix)
+
+                    if sparse and _is_empty(matrix, meta['nodata']):
+                        # Unwritten blocks read back as nodata, and the overviews already start out as nodata
+                        empty_blocks += 1
+                        continue
+
+                    for band_no, band_data in enumerate(matrix, start=1):
+                        mem.GetRasterBand(band_no).WriteArray(band_data, w.col_off, w.row_off)
+                    if pyramid is not None:
+                        pyramid.add_block(w, matrix)
+
+                # Stored as the band metadata GDAL reads back, instead of computing them with another pass
+                for band_no in range(meta['count']):
+                    mem.GetRasterBand(band_no + 1).SetMetadata(statistics.tags(band_no))
+
+                if sparse:
+                    LOG.debug('Skipped empty blocks', count=empty_blocks, filename=dst_path)
+
+                if pyramid is not None and pyramid.factors:
+                    _write_overviews(mem, pyramid)
+
+                try:
+                    gdal.GetDriverByName('GTiff').CreateCopy(dst_path, mem, options=_creation_options(dst_kwargs))
+                    LOG.info(f"Created a cloud optimized GeoTIFF file, {dst_path}")
+                except Exception:
+                    LOG.exception(f"Error while creating a cloud optimized GeoTIFF file, {dst_path}")
+                    raise
+            finally:
+                mem = None
+                gdal.Unlink(tmp_path)
+
+
+def cog_translate_gdal(
+        src_path,
+        dst_path,
+        dst_kwargs,
+        indexes=None,
+        overview_level=None,
+        overview_resampling=None,
+        config=None,
+        sparse=False,
+        byte_nodata=None,
+        datasets=None,
+):
+    """
+    Create Cloud Optimized Geotiff with GDAL's COG driver (GDAL >= 3.1).
+
+    Takes the same arguments as `cog_translate`, but writes the final layout directly from the
+    source, so every pixel is only encoded once. Overviews are added until the smallest one fits
+    in a single block, unless `overview_level` is given.
+    """
+    if int(gdal.VersionInfo('VERSION_NUM')) < 3010000:
+        raise COGException('The COG engine requires GDAL 3.1 or later')
+
+    config = config or {}
+
+    creation_options = {
+        'COMPRESS': dst_kwargs.get('compress', 'DEFLATE'),
+        'LEVEL': dst_kwargs.get('zlevel', 9),
+        'PREDICTOR': COG_DRIVER_PREDICTORS[int(dst_kwargs.get('predictor', 1))],
+        'BLOCKSIZE': dst_kwargs.get('blockxsize', 512),
+        'NUM_THREADS': config.get('NUM_THREADS', 1),
+        'BIGTIFF': 'IF_SAFER',
+    }
+    if isinstance(overview_resampling, list):
+        if len(set(overview_resampling)) > 1:
+            raise COGException('The COG engine uses one overview resampling for all bands, use the gtiff engine')
+        overview_resampling = overview_resampling[0]
+
+    if overview_resampling is None:
+        creation_options['OVERVIEWS'] = 'NONE'
+    else:
+        creation_options['OVERVIEWS'] = 'IGNORE_EXISTING'
+        creation_options['RESAMPLING'] = Resampling[overview_resampling].name.upper()
+        if overview_level is not None:
+            creation_options['OVERVIEW_COUNT'] = overview_level
+    if sparse or dst_kwargs.get('sparse_ok'):
+        creation_options['SPARSE_OK'] = 'TRUE'
+
+    with _conversion_env(config, rasterio_env=False):
+        src = _gdal_open(src_path, datasets)
+        band_list = list(indexes) if indexes else None
+
+        translate_options = {}
+        nodata_mask, nodata, dtype = _nodata_mask(src_path, byte_nodata, datasets)
+        if nodata_mask is not None and nodata == nodata_mask:
+            # The nodata pixels already hold the new nodata value, only the declared nodata changes
+            translate_options['noData'] = nodata
+        elif nodata_mask is not None:
+            # Same remapping as `cog_translate`, done in memory as the COG driver can't remap values
+            src = _remap_nodata(src, band_list or list(range(1, src.RasterCount + 1)), nodata_mask, nodata, dtype)
+            band_list = None
+
+        try:
+            gdal.Translate(dst_path, src, format='COG', bandList=band_list,
+                           creationOptions=[f'{key}={value}' for key, value in creation_options.items()],
+                           **translate_options)
+            LOG.info(f"Created a cloud optimized GeoTIFF file, {dst_path}")
+        except Exception:
+            LOG.exception(f"Error while creating a cloud optimized GeoTIFF file, {dst_path}")
+            raise
+
+
+COG_ENGINES = {
+    'gtiff': cog_translate,
+    'cog': cog_translate_gdal,
+}
+
+# PREDICTOR creation option values of the COG driver, from the TIFF predictor numbers used by GTiff
+COG_DRIVER_PREDICTORS = {1: 'NO', 2: 'STANDARD', 3: 'FLOATING_POINT'}
+
+# Options of the output profile which also shape the intermediate GeoTIFF, so its blocks line up with the output's
+INTERMEDIATE_OPTIONS = ('tiled', 'blockxsize', 'blockysize', 'interleave', 'sparse_ok')
+
+
+def _nodata_mask(src_path, byte_nodata=None, datasets=None):
+    """
+    Return ``(nodata_mask, nodata, dtype)`` of a source. For a Byte band with a negative nodata,
+    `nodata_mask` is the value standing for nodata in the data, to be replaced by the output `nodata`
+    in the output `dtype`: widened to int16 to keep the negative nodata, or kept as Byte with the
+    `byte_nodata` value. Otherwise `nodata_mask` is None.
+    """
+    src = _gdal_open(src_path, datasets)
+    band = src.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+
+    # Update nodata mask only if nodata is a negative integer value
+    if band.DataType == gdal.GDT_Byte and nodata and nodata < 0:
+        if byte_nodata is not None:
+            return 255, byte_nodata, 'uint8'
+        return 255, nodata, 'int16'
+    return None, nodata, None
+
+
+def _source_file(path):
+    """
+    Return the file of a GDAL dataset path, eg. ``file.nc`` of the ``NETCDF:"file.nc":band`` subdataset
+    """
+    if path.startswith('NETCDF:'):
+        return path[len('NETCDF:'):].rsplit(':', 1)[0].strip('"')
+    return path
+
+
+def _gdal_open(path, datasets=None):
+    """
+    Open a source with GDAL, from the cache of open datasets when there is one
+    """
+    if datasets is None:
+        return gdal.Open(path, gdal.GA_ReadOnly)
+    return datasets.gdal_open(path)
+
+
+@contextmanager
+def _open_source(path, datasets=None):
+    """
+    Open a source with rasterio, from the cache of open datasets when there is one, which keeps it open
+    """
+    if datasets is None:
+        with rasterio.open(path) as src:
+            yield src
+    else:
+        yield datasets.rasterio_open(path)
+
+
+def _close_dataset(dataset):
+    # rasterio datasets need closing, GDAL ones are closed once no longer referenced
+    if hasattr(dataset, 'close'):
+        dataset.close()
+
+
+def _apply_nodata_mask(data, nodata_mask, nodata, dtype):
+    """
+    Return Byte `data` as `dtype`, with its `nodata_mask` values replaced by `nodata`
+    """
+    if numpy.dtype(dtype) == numpy.uint8:
+        if nodata == nodata_mask:
+            return data
+        if numpy.any(data == nodata):
+            raise COGException(f'Valid pixels have the value {nodata}, choose another byte_nodata')
+    data = numpy.array(data, dtype=dtype)
+    data[data == nodata_mask] = nodata
+    return data
+
+
+def _remap_nodata(src, band_list, nodata_mask, nodata, dtype):
+    """
+    Copy bands of a Byte dataset to a `dtype` in-memory dataset, replacing `nodata_mask` values by `nodata`
+    """
+    mem = gdal.GetDriverByName('MEM').Create('', src.RasterXSize, src.RasterYSize, len(band_list),
+                                             _gdal_data_type(dtype))
+    mem.SetGeoTransform(src.GetGeoTransform())
+    mem.SetProjection(src.GetProjection())
+    for mem_band_no, src_band_no in enumerate(band_list, start=1):
+        data = _apply_nodata_mask(src.GetRasterBand(src_band_no).ReadAsArray(), nodata_mask, nodata, dtype)
+        mem_band = mem.GetRasterBand(mem_band_no)
+        mem_band.WriteArray(data)
+        mem_band.SetNoDataValue(nodata)
+    return mem
+
+
+def _stack_bands(vrt_fname, subdatasets, band_index, datasets=None):
+    """
+    Write a VRT stacking the `band_index` band of each of `subdatasets`, which must share a data type and nodata
+    """
+    if not subdatasets:
+        raise COGException(f'No bands selected to write to {vrt_fname}')
+    first = _gdal_open(subdatasets[0], datasets)
+    block_xsize, block_ysize = first.GetRasterBand(band_index).GetBlockSize()
+
+    # Keep the source chunking, so the output blocks are still read in chunk aligned strips
+    vrt = gdal.GetDriverByName('VRT').Create(vrt_fname, first.RasterXSize, first.RasterYSize, 0,
+                                             options=[f'BLOCKXSIZE={block_xsize}', f'BLOCKYSIZE={block_ysize}'])
+    vrt.SetGeoTransform(first.GetGeoTransform())
+    vrt.SetProjection(first.GetProjection())
+
+    band_kinds = set()
+    for subdataset in subdatasets:
+        src_band = _gdal_open(subdataset, datasets).GetRasterBand(band_index)
+        nodata = src_band.GetNoDataValue()
+        band_kinds.add((src_band.DataType, str(nodata)))
+
+        vrt.AddBand(src_band.DataType)
+        vrt_band = vrt.GetRasterBand(vrt.RasterCount)
+        vrt_band.SetMetadataItem('source_0',
+                                 f'<SimpleSource><SourceFilename relativeToVRT="0">{escape(subdataset)}'
+                                 f'</SourceFilename><SourceBand>{band_index}</SourceBand></SimpleSource>',
+                                 'new_vrt_sources')
+        if nodata is not None:
+            vrt_band.SetNoDataValue(nodata)
+
+    if len(band_kinds) > 1:
+        raise COGException(f'Bands in a multi band GeoTIFF must share a data type and nodata value, '
+                           f'found {sorted(band_kinds)}')
+    vrt.FlushCache()
+    del vrt
+
+
+@contextmanager
+def _conversion_env(config, rasterio_env=True):
+    """
+    Apply GDAL config to the GDAL bindings, and to rasterio, for one conversion
+
+    Does nothing within a `ConversionContext`, which keeps its own environment active for every conversion.
+    """
+    if ConversionContext.active is not None:
+        yield
+        return
+
+    with ExitStack() as env:
+        if rasterio_env:
+            env.enter_context(rasterio.Env(**config))
+        env.enter_context(_gdal_config_options(config))
+        yield
+
+
+@contextmanager
+def _gdal_config_options(config):
+    """
+    Set GDAL configuration options for the duration of a block, like `rasterio.Env` does for rasterio
+    """
+    previous = {key: gdal.GetConfigOption(key) for key in config}
+    for key, value in config.items():
+        gdal.SetConfigOption(key, str(value))
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            gdal.SetConfigOption(key, value)
+
+
+def _is_empty(data, nodata):
+    """
+    Whether a block holds nothing but nodata, or only zeros when there's no nodata value
+    """
+    if nodata is None:
+        return not data.any()
+    if numpy.isnan(nodata):
+        return numpy.isnan(data).all()
+    return (data == nodata).all()
+
+
+def _creation_options(kwargs):
+    """
+    Return GDAL creation options from rasterio style keyword arguments, as rasterio itself passes them on
+    """
+    options = []
+    for key, value in kwargs.items():
+        if key == 'driver':
+            continue
+        if isinstance(value, bool):
+            value = 'YES' if value else 'NO'
+        options.append(f'{key.upper()}={value}')
+    return options
+
+
+def _create_intermediate(path, meta):
+    """
+    Create the uncompressed intermediate GeoTIFF, with the size, data type, georeferencing and block layout of `meta`
+    """
+    options = _creation_options({key: meta[key] for key in INTERMEDIATE_OPTIONS if key in meta})
+    dataset = gdal.GetDriverByName('GTiff').Create(path, meta['width'], meta['height'], meta['count'],
+                                                   _gdal_data_type(meta['dtype']),
+                                                   options=options + ['BIGTIFF=IF_NEEDED'])
+    dataset.SetGeoTransform(meta['transform'].to_gdal())
+    if meta['crs'] is not None:
+        dataset.SetProjection(meta['crs'].to_wkt())
+    if meta['nodata'] is not None:
+        for band_no in range(meta['count']):
+            dataset.GetRasterBand(band_no + 1).SetNoDataValue(meta['nodata'])
+    return dataset
+
+
+def _gdal_data_type(dtype):
+    """
+    Return the GDAL data type of a numpy or rasterio dtype name
+    """
+    try:
+        data_type = gdal_array.NumericTypeCodeToGDALTypeCode(numpy.dtype(dtype))
+    except TypeError:
+        data_type = None
+    if data_type == gdal.GDT_Byte and numpy.dtype(dtype) != numpy.uint8:
+        # GDAL before 3.7 has no signed byte type, and maps int8 to Byte
+        data_type = None
+    if data_type is None:
+        raise COGException(f'Bands of data type {dtype} are not supported by GDAL {gdal.__version__}')
+    return data_type
+
+
+def _block_windows(width, height, blockxsize, blockysize):
+    """
+    Yield the windows of the blocks of a tiled raster, row by row, as GDAL and rasterio order them
+    """
+    for row_off in range(0, height, blockysize):
+        for col_off in range(0, width, blockxsize):
+            yield Window(col_off, row_off, min(blockxsize, width - col_off), min(blockysize, height - row_off))
+
+
+def _write_overviews(dataset, pyramid):
+    """
+    Store the overview levels accumulated while writing the full resolution image
+
+    The overviews are created with the 'NONE' resampling, which allocates them without
+    reading the base image, and then filled in from the accumulated arrays.
+    """
+    dataset.BuildOverviews('NONE', pyramid.factors)
+
+    for band_no, resampling in enumerate(pyramid.resampling):
+        band = dataset.GetRasterBand(band_no + 1)
+        for level_no, level in enumerate(pyramid.levels):
+            band.GetOverview(level_no).WriteArray(level[band_no])
+
+    if len(set(pyramid.resampling)) == 1:
+        dataset.SetMetadataItem('OVR_RESAMPLING_ALG', Resampling[pyramid.resampling[0]].name.upper())
+    else:
+        for band_no, resampling in enumerate(pyramid.resampling):
+            dataset.GetRasterBand(band_no + 1).SetMetadataItem('OVR_RESAMPLING_ALG',
+                                                               Resampling[resampling].name.upper())
+    dataset.FlushCache()
+
+
+def _strip_cache_bytes(src, band_count):
+    """
+    Return the number of bytes needed to hold one full-width strip of source chunks
+    """
+    chunk_rows, chunk_cols = src.block_shapes[0]
+    chunks_per_strip = -(-src.width // chunk_cols)
+    itemsize = numpy.dtype(src.dtypes[0]).itemsize
+    return chunks_per_strip * chunk_rows * chunk_cols * itemsize * band_count
+
+
+def _check_chunk_cache(src, band_count):
+    """
+    Log when a full strip of source chunks doesn't fit in the netCDF/HDF5 chunk cache
+
+    Each strip is read with a single read, so the GDAL block cache is left at the rank's budget from
+    `dea_cogger.resources.apply_resource_plan`. The chunk cache size is only read when a file is opened,
+    so it's also sized there, before any file is opened, rather than for the already open source.
+    """
+    strip_bytes = _strip_cache_bytes(src, band_count)
+
+    if netCDF4 is not None:
+        chunk_cache_bytes, _, _ = netCDF4.get_chunk_cache()
+        if chunk_cache_bytes < strip_bytes:
+            LOG.debug('Source strip larger than the chunk cache', strip_bytes=strip_bytes,
+                      chunk_cache_bytes=chunk_cache_bytes)
+
+    LOG.debug('Source strip size', source_chunk_shape=src.block_shapes[0], strip_bytes=strip_bytes)
+
+
+def _chunk_aligned_blocks(src, windows, indexes):
+    """
+    Yield ``(window, data)`` for every one of the output block ``windows``, in row order, reading ``src``
+    in strips aligned to its chunking
+
+    NetCDF/HDF5 chunks rarely line up with the 512x512 output blocks, and reading the source window
+    by window decompresses the chunks straddling a block boundary several times, unless the GDAL block
+    cache holds a whole row of them. Instead, read
+    full-width strips whose height is a multiple of the source chunk height, and keep the rows that
+    are still needed by the next row of output blocks buffered.
+    """
+    chunk_rows = src.block_shapes[0][0]
+
+    strip = None
+    strip_start = strip_stop = 0
+    for window in windows:
+        row_start = window.row_off
+        row_stop = window.row_off + window.height
+
+        if row_stop > strip_stop:
+            # Extend the strip to the next chunk boundary, dropping rows already consumed
+            read_stop = min(-(-row_stop // chunk_rows) * chunk_rows, src.height)
+            data = src.read(window=Window(0, strip_stop, src.width, read_stop - strip_stop), indexes=indexes)
+            if strip is not None:
+                data = numpy.concatenate([strip[:, row_start - strip_start:], data], axis=1)
+                strip_start = row_start
+            strip = data
+            strip_stop = read_stop
+
+        yield window, strip[:,
+                            row_start - strip_start:row_stop - strip_start,
+                            window.col_off:window.col_off + window.width]
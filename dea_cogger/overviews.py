@@ -0,0 +1,155 @@
+"""
+Build COG overview pyramids while the full resolution blocks are being written
+
+Each full resolution block is reduced to every overview level as soon as it has been read, so the
+pyramid is finished when the last block is written and the base image never has to be read again.
+
+Compared to GDAL's own resampling of a power of two overview whose factor divides the raster size:
+
+- ``nearest`` picks the same source pixel, the one at the centre of each window, so it matches exactly.
+- ``average`` averages the same non-nodata pixels, matching within 1 for integer types (rounding) and
+  within float precision for floating point types.
+- ``mode`` picks the same most frequent non-nodata value, ties are broken towards the smallest value
+  which can differ from GDAL.
+
+When the raster size isn't a multiple of the factor, GDAL stretches its windows to cover the odd
+remainder, so pixels along the right and bottom edges may differ.
+
+``tests/test_overviews.py`` checks these tolerances against ``gdal.RegenerateOverview``.
+"""
+import numpy
+
+RESAMPLING_METHODS = ('average', 'nearest', 'mode')
+
+
+def overview_factors(width, height, blocksize=512, overview_level=None):
+    """
+    Return the decimation factors of the overview levels for a raster
+
+    By default, add levels until the smallest overview fits within a single block, so a raster which
+    already fits in one block gets none. The factors
+    never exceed the block size, so each full resolution block maps onto whole overview pixels.
+    """
+    size = max(width, height)
+    factors = []
+    factor = 2
+    while factor <= blocksize:
+        if overview_level is None and -(-size // (factor // 2)) <= blocksize:
+            break
+        if overview_level is not None and len(factors) == overview_level:
+            break
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+class OverviewPyramid:
+    """
+    Accumulate the overview levels of a raster from its full resolution blocks
+
+    :param resampling: one of `RESAMPLING_METHODS`, or a list with one per band
+    """
+
+    def __init__(self, width, height, count, dtype, factors, resampling, nodata=None):
+        if isinstance(resampling, str):
+            resampling = [resampling] * count
+        unknown = set(resampling) - set(RESAMPLING_METHODS)
+        if unknown:
+            raise ValueError(f'Unsupported overview resampling: {unknown}')
+
+        self.factors = factors
+        self.resampling = resampling
+        self.dtype = numpy.dtype(dtype)
+        self.nodata = nodata
+        self.fill = nodata if nodata is not None else 0
+        self.levels = [numpy.full((count, -(-height // factor), -(-width // factor)), self.fill, dtype=self.dtype)
+                       for factor in factors]
+
+    def add_block(self, window, data):
+        """
+        Reduce a full resolution block, shaped (bands, rows, cols), into every overview level
+
+        The block must be aligned on a multiple of the largest factor, as output blocks are.
+        """
+        valid = self._valid(data)
+        for factor, level in zip(self.factors, self.levels):
+            row = window.row_off // factor
+            col = window.col_off // factor
+            for band, method in enumerate(self.resampling):
+                reduced = _REDUCERS[method](data[band], valid[band], factor, self.fill)
+                level[band, row:row + reduced.shape[0], col:col + reduced.shape[1]] = reduced
+
+    def _valid(self, data):
+        valid = numpy.ones(data.shape, dtype=bool)
+        if self.dtype.kind == 'f':
+            valid &= ~numpy.isnan(data)
+        if self.nodata is not None and not numpy.isnan(self.nodata):
+            valid &= data != self.nodata
+        return valid
+
+
+def _windows(data, valid, factor):
+    """
+    Reshape a 2D block into (out_rows, out_cols, factor * factor) windows, padding the edges as invalid
+    """
+    rows, cols = data.shape
+    pad = ((0, -rows % factor), (0, -cols % factor))
+    data = numpy.pad(data, pad, mode='edge')
+    valid = numpy.pad(valid, pad, mode='constant', constant_values=False)
+
+    out_rows, out_cols = data.shape[0] // factor, data.shape[1] // factor
+
+    def reshape(arr):
+        return (arr.reshape(out_rows, factor, out_cols, factor)
+                .transpose(0, 2, 1, 3)
+                .reshape(out_rows, out_cols, factor * factor))
+
+    return reshape(data), reshape(valid)
+
+
+def _average(data, valid, factor, fill):
+    windows, valid = _windows(data, valid, factor)
+    counts = valid.sum(axis=-1)
+    totals = numpy.where(valid, windows, 0).sum(axis=-1, dtype='float64')
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = totals / counts
+    if data.dtype.kind in 'iub':
+        mean = numpy.rint(mean)
+    return numpy.where(counts > 0, mean, fill).astype(data.dtype)
+
+
+def _nearest(data, valid, factor, fill):
+    rows, cols = data.shape
+    row_idx = numpy.minimum(numpy.arange(-(-rows // factor)) * factor + factor // 2, rows - 1)
+    col_idx = numpy.minimum(numpy.arange(-(-cols // factor)) * factor + factor // 2, cols - 1)
+    return data[numpy.ix_(row_idx, col_idx)]
+
+
+def _mode(data, valid, factor, fill):
+    windows, valid = _windows(data, valid, factor)
+    out_shape = windows.shape[:2]
+    windows = windows.reshape(-1, windows.shape[-1])
+    valid = valid.reshape(windows.shape)
+
+    # Sort every window, then count the valid pixels in each run of equal values
+    order = numpy.argsort(windows, axis=1, kind='stable')
+    values = numpy.take_along_axis(windows, order, axis=1)
+    weights = numpy.take_along_axis(valid, order, axis=1)
+
+    run_starts = numpy.ones(values.shape, dtype=bool)
+    run_starts[:, 1:] = values[:, 1:] != values[:, :-1]
+    run_ids = numpy.cumsum(run_starts.ravel()) - 1
+    run_counts = numpy.bincount(run_ids, weights=weights.ravel())[run_ids].reshape(values.shape)
+
+    rows = numpy.arange(values.shape[0])
+    best = run_counts.argmax(axis=1)
+    result = values[rows, best]
+    result[run_counts[rows, best] == 0] = fill
+    return result.reshape(out_shape)
+
+
+_REDUCERS = {
+    'average': _average,
+    'nearest': _nearest,
+    'mode': _mode,
+}
@@ -0,0 +1,146 @@
+"""
+Low overhead sampling profiler for conversion runs
+
+Samples the Python call stack on a CPU time timer, and writes the samples in the collapsed stack format
+read by flamegraph.pl and speedscope. Time spent inside GDAL, HDF5 and zlib is attributed to the Python
+call waiting on it, eg. reading a block, building overviews or copying to the output GeoTIFF.
+"""
+import os
+import signal
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+import click
+import structlog
+
+LOG = structlog.get_logger()
+
+# Seconds of process CPU time between samples
+DEFAULT_INTERVAL = 0.01
+
+COLLAPSED_EXT = '.collapsed'
+
+
+class StackSampler:
+    """
+    Sample the main thread's call stack every `interval` seconds of process CPU time
+
+    Signals arriving during a long call into a C library are coalesced into one, so each sample is
+    weighted by the CPU time used since the previous one, in milliseconds, rather than counted once.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._previous_handler = None
+        self._last_cpu_time = None
+
+    def _sample(self, signum, frame):
+        cpu_time = time.process_time()
+        weight = int(round((cpu_time - self._last_cpu_time) * 1000))
+        self._last_cpu_time = cpu_time
+
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += max(weight, 1)
+
+    def start(self):
+        self._last_cpu_time = time.process_time()
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        # Python installs handlers without SA_RESTART, restart the system calls the samples land in
+        # instead of failing them with EINTR in HDF5, MPI or Lustre
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def write_collapsed(stacks, filename):
+    """
+    Write a Counter of stacks in the collapsed stack format, one ``frame;frame;frame weight`` per line
+    """
+    with open(filename, 'w') as fout:
+        for stack, weight in sorted(stacks.items()):
+            fout.write(f'{stack} {weight}\n')
+
+
+def _mpi_comm():
+    try:
+        from mpi4py import MPI
+        return MPI.COMM_WORLD
+    except ImportError:
+        return None
+
+
+@contextmanager
+def profile_run(profile_dir, name, ranks=None, sample_whole_run=True):
+    """
+    Profile a command, writing a collapsed stack file per MPI rank and a merged one from rank 0
+
+    Must be entered by every rank, the samples are gathered onto rank 0 on exit.
+
+    :param profile_dir: output directory, or None to not profile at all
+    :param name: prefix of the output files
+    :param ranks: optional collection of the MPI ranks to profile, default all of them
+    :param sample_whole_run: start sampling straight away, otherwise the caller starts and stops
+        the yielded sampler around the parts of the run to profile
+    :return: the `StackSampler` of this rank, or None when it isn't being profiled
+    """
+    if profile_dir is None:
+        yield None
+        return
+
+    comm = _mpi_comm()
+    rank, size = (comm.rank, comm.size) if comm is not None else (0, 1)
+
+    sampler = StackSampler() if ranks is None or rank in ranks else None
+    if sampler is not None and sample_whole_run:
+        sampler.start()
+    try:
+        yield sampler
+    finally:
+        if sampler is not None and sample_whole_run:
+            sampler.stop()
+
+    Path(profile_dir).mkdir(parents=True, exist_ok=True)
+    stacks = sampler.stacks if sampler is not None else Counter()
+    if sampler is not None:
+        rank_file = Path(profile_dir) / f'{name}_rank{rank:04d}{COLLAPSED_EXT}'
+        write_collapsed(stacks, rank_file)
+        LOG.info('Wrote profile', filename=str(rank_file), cpu_ms=sum(stacks.values()))
+
+    if size > 1:
+        gathered = comm.gather(stacks, root=0)
+        if rank != 0:
+            return
+        stacks = sum(gathered, Counter())
+
+    merged_file = Path(profile_dir) / f'{name}{COLLAPSED_EXT}'
+    write_collapsed(stacks, merged_file)
+    LOG.info('Wrote merged profile', filename=str(merged_file), cpu_ms=sum(stacks.values()))
+
+
+def parse_ranks(ctx, param, value):
+    """
+    Click callback parsing a comma separated list of MPI ranks
+    """
+    if value is None:
+        return None
+    try:
+        return set(int(rank) for rank in value.split(','))
+    except ValueError:
+        raise click.BadParameter('Expected a comma separated list of ranks, eg. 0,4,8')
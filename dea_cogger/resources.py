@@ -0,0 +1,178 @@
+"""
+Share a node's cores and memory between the MPI ranks running on it
+
+GDAL's block cache and thread pool, and the netCDF/HDF5 chunk cache, are all per process. With many ranks
+on a node, the defaults either leave most of the memory unused or oversubscribe it, so size them from
+the node's resources available to the job divided by the number of ranks on the node.
+"""
+import os
+from pathlib import PurePosixPath
+
+import structlog
+
+LOG = structlog.get_logger()
+
+# Fraction of the node memory given over to GDAL block caches, across all ranks
+CACHE_MEMORY_FRACTION = 0.25
+
+# Fraction of each rank's GDAL cache budget given to the netCDF/HDF5 chunk cache
+CHUNK_CACHE_FRACTION = 0.25
+
+MIN_CACHE_BYTES = 64 * 1024 * 1024
+
+# Environment variables set by the common MPI launchers with the number of ranks on this node
+LOCAL_SIZE_ENV_VARS = ('OMPI_COMM_WORLD_LOCAL_SIZE', 'MPI_LOCALNRANKS', 'MV2_COMM_WORLD_LOCAL_SIZE')
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def _node_cores():
+    """
+    Number of cores this process may run on, ie. the job's cpuset rather than the whole node
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _cgroup_memory_limit_files():
+    """
+    Yield the memory limit files of this process's cgroups and their ancestors, eg. the PBS job's cgroup
+    """
+    try:
+        with open('/proc/self/cgroup') as fin:
+            lines = fin.read().splitlines()
+    except OSError:
+        return
+
+    for line in lines:
+        _, controllers, path = line.split(':', 2)
+        if not controllers:
+            limit_dir, limit_name = CGROUP_ROOT, 'memory.max'  # cgroup v2
+        elif 'memory' in controllers.split(','):
+            limit_dir, limit_name = f'{CGROUP_ROOT}/memory', 'memory.limit_in_bytes'
+        else:
+            continue
+
+        cgroup = PurePosixPath(path)
+        for parent in [cgroup, *cgroup.parents]:
+            yield os.path.join(limit_dir, str(parent).lstrip('/'), limit_name)
+
+
+def _node_memory():
+    """
+    Physical memory of the node in bytes, or the memory limit of the job if that's lower
+
+    The job's limit is the lowest of those of the cgroups this process is nested in, and PBS_VMEM.
+    """
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for limit_file in _cgroup_memory_limit_files():
+        try:
+            with open(limit_file) as fin:
+                limit = fin.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+
+    pbs_vmem = os.environ.get('PBS_VMEM', '')
+    if pbs_vmem.isdigit():
+        memory = min(memory, int(pbs_vmem))
+    return memory
+
+
+def _ranks_per_node():
+    """
+    Number of MPI ranks sharing this node, from MPI itself, the launcher's or PBS's environment, or 1
+    """
+    try:
+        from mpi4py import MPI
+        return MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED).size
+    except ImportError:
+        pass
+
+    for env_var in LOCAL_SIZE_ENV_VARS:
+        if env_var in os.environ:
+            return int(os.environ[env_var])
+
+    pbs_ncpus = os.environ.get('PBS_NCPUS')
+    pbs_nodefile = os.environ.get('PBS_NODEFILE')
+    if pbs_ncpus is not None and pbs_nodefile is not None:
+        try:
+            with open(pbs_nodefile) as fin:
+                nodes = len(set(line.strip() for line in fin if line.strip()))
+            return max(1, int(pbs_ncpus) // max(nodes, 1))
+        except OSError:
+            pass
+
+    return 1
+
+
+def _loaded_netcdf_libraries():
+    """
+    Paths of the copies of libnetcdf loaded into this process, or None when they can't be listed
+
+    Wheels of netCDF4-python and rasterio each bundle a copy, and the chunk cache of one doesn't apply to the other.
+    """
+    try:
+        with open('/proc/self/maps') as fin:
+            paths = set(line.split()[-1] for line in fin if len(line.split()) > 5)
+    except OSError:
+        return None
+    return set(path for path in paths if os.path.basename(path).startswith('libnetcdf'))
+
+
+def plan_resources():
+    """
+    Work out the GDAL thread count and cache sizes for this process
+
+    :return: dict of num_threads, cache_bytes and chunk_cache_bytes, plus the node figures they were derived from
+    """
+    cores = _node_cores()
+    memory = _node_memory()
+    ranks = _ranks_per_node()
+
+    cache_bytes = max(MIN_CACHE_BYTES, int(memory * CACHE_MEMORY_FRACTION / ranks))
+    return dict(
+        node_cores=cores,
+        node_memory=memory,
+        ranks_per_node=ranks,
+        num_threads=max(1, cores // ranks),
+        cache_bytes=cache_bytes,
+        chunk_cache_bytes=int(cache_bytes * CHUNK_CACHE_FRACTION),
+    )
+
+
+def apply_resource_plan(gdal_config):
+    """
+    Size GDAL's thread pool and caches for this rank, updating `gdal_config` in place for later `rasterio.Env` use
+
+    The returned plan's `chunk_cache_applied` is false when the netCDF chunk cache may not reach GDAL.
+    """
+    import gdal
+    from dea_cogger.cogeo import netCDF4
+
+    plan = plan_resources()
+
+    gdal_config['NUM_THREADS'] = plan['num_threads']
+    gdal_config['GDAL_CACHEMAX'] = plan['cache_bytes'] // (1024 * 1024)  # In MB
+
+    # The block cache size is only read from the config once, so set it directly too
+    gdal.SetCacheMax(plan['cache_bytes'])
+
+    # Only applies to files opened afterwards, so this must run before the rank opens any source
+    if netCDF4 is not None:
+        _, nelems, preemption = netCDF4.get_chunk_cache()
+        netCDF4.set_chunk_cache(plan['chunk_cache_bytes'], nelems, preemption)
+
+    # The chunk cache is set through netCDF4-python, so it only reaches GDAL when both use the same libnetcdf
+    netcdf_libraries = _loaded_netcdf_libraries()
+    plan['chunk_cache_applied'] = netCDF4 is not None and netcdf_libraries is not None and len(netcdf_libraries) == 1
+    if not plan['chunk_cache_applied']:
+        LOG.warning('The netCDF chunk cache size may not apply to the GDAL netCDF driver',
+                    netcdf4_python=netCDF4 is not None,
+                    netcdf_libraries=sorted(netcdf_libraries) if netcdf_libraries is not None else None)
+
+    LOG.info('Planned GDAL resources', **plan)
+    return plan
@@ -0,0 +1,82 @@
+"""
+Accumulate band statistics while the full resolution blocks are being written
+
+Every valid pixel passes through the block loop once anyway, so the statistics GDAL would otherwise
+compute with another full read of the output are gathered from each block as it's written, and
+stored as the ``STATISTICS_*`` band metadata items GDAL itself writes and reads back.
+
+The standard deviation is the population one, as computed by GDAL, combined across blocks with
+Chan et al.'s parallel algorithm so it's exact rather than derived from a running sum of squares.
+"""
+import numpy
+
+
+class BandStatistics:
+    """
+    Running minimum, maximum, mean, standard deviation and valid pixel count of each band of an image
+    """
+
+    def __init__(self, count, nodata=None, total_pixels=None):
+        """
+        :param count: number of bands
+        :param nodata: pixels with this value (and NaN pixels) are excluded
+        :param total_pixels: pixels per band of the whole image, for the valid percentage
+        """
+        self.nodata = nodata
+        self.total_pixels = total_pixels
+        self.valid = numpy.zeros(count, dtype='int64')
+        self.minimum = numpy.full(count, numpy.inf)
+        self.maximum = numpy.full(count, -numpy.inf)
+        self.mean = numpy.zeros(count)
+        self.m2 = numpy.zeros(count)
+
+    def _valid_values(self, band):
+        if numpy.issubdtype(band.dtype, numpy.floating):
+            valid = ~numpy.isnan(band)
+            if self.nodata is not None and not numpy.isnan(self.nodata):
+                valid &= band != self.nodata
+            return band[valid]
+        if self.nodata is not None:
+            return band[band != self.nodata]
+        return band
+
+    def add_block(self, data):
+        """
+        Add a block of shape ``(count, rows, cols)``, or ``(rows, cols)`` for a single band
+        """
+        data = data.reshape(len(self.valid), -1)
+        for band_no, band in enumerate(data):
+            values = self._valid_values(band)
+            if values.size == 0:
+                continue
+
+            values = values.astype('float64')
+            block_valid = values.size
+            block_mean = values.mean()
+            block_m2 = numpy.square(values - block_mean).sum()
+
+            valid = self.valid[band_no] + block_valid
+            delta = block_mean - self.mean[band_no]
+            self.mean[band_no] += delta * block_valid / valid
+            self.m2[band_no] += block_m2 + delta * delta * self.valid[band_no] * block_valid / valid
+            self.valid[band_no] = valid
+
+            self.minimum[band_no] = min(self.minimum[band_no], values.min())
+            self.maximum[band_no] = max(self.maximum[band_no], values.max())
+
+    def tags(self, band_no):
+        """
+        Return the ``STATISTICS_*`` metadata items of a band, numbered from 0, or nothing if it has no valid pixels
+        """
+        if not self.valid[band_no]:
+            return {}
+
+        tags = dict(
+            STATISTICS_MINIMUM=repr(float(self.minimum[band_no])),
+            STATISTICS_MAXIMUM=repr(float(self.maximum[band_no])),
+            STATISTICS_MEAN=repr(float(self.mean[band_no])),
+            STATISTICS_STDDEV=repr(float(numpy.sqrt(self.m2[band_no] / self.valid[band_no]))),
+        )
+        if self.total_pixels:
+            tags['STATISTICS_VALID_PERCENT'] = repr(100. * int(self.valid[band_no]) / self.total_pixels)
+        return tags
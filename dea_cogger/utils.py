@@ -1,49 +1,190 @@
+import heapq
 import os
 import re
 import subprocess
 import sys
 from os.path import split, basename
+from types import SimpleNamespace
 
 import click
 import dateutil.parser
 import structlog
-from datacube import Datacube
-from datacube.ui import parse_expressions
-
-from dea_cogger.cogeo import NetCDFCOGConverter
 
 LOG = structlog.get_logger()
 
+# GDAL virtual file systems of the remote URL schemes accepted as inputs
+REMOTE_SCHEMES = {'s3://': '/vsis3/', 'https://': '/vsicurl/https://', 'http://': '/vsicurl/http://'}
+
 
 def get_dataset_values(product_name, product_config, time_range=None):
     """
     Extract the file list corresponding to a product for the given year and month using datacube API.
     """
+    from datacube import Datacube
+
     try:
         query = {**dict(product=product_name), **time_range}
     except TypeError:
         # Time range is None
         query = {**dict(product=product_name)}
 
-    dc = Datacube(app='cog-worklist query')
+    if uses_document_fields(product_config):
+        # Pull only the values needed out of the dataset documents, rather than every whole document
+        index_rows = _search_index(product_name, product_config, time=query.get('time'))
+        ds_values = ((uri, basename) for uri, basename, _ in index_rows)
+    else:
+        dc = Datacube(app='cog-worklist query')
 
-    field_names = get_field_names(product_config)
+        field_names = get_field_names(product_config)
 
-    LOG.info(f"Perform a datacube dataset search returning only the specified fields, {field_names}.")
-    ds_records = dc.index.datasets.search_returning(field_names=tuple(field_names), **query)
+        LOG.info(f"Perform a datacube dataset search returning only the specified fields, {field_names}.")
+        ds_records = dc.index.datasets.search_returning(field_names=tuple(field_names), **query)
+        ds_values = ((ds_rec.uri, filename_prefix_from_dataset(ds_rec, product_config)) for ds_rec in ds_records)
 
     search_results = False
-    for ds_rec in ds_records:
+    for ds_value in ds_values:
         search_results = True
-        yield ds_rec.uri, filename_prefix_from_dataset(ds_rec, product_config)
+        yield ds_value
 
     if not search_results:
         LOG.warning(f"Datacube product query is empty for {product_name} product with time-range, {time_range}")
 
 
+def get_changed_dataset_values(product_name, product_config, since=None):
+    """
+    Extract the file list of the datasets of a product added or updated since a point in time
+
+    :return: generator of (uri, basename, change time)
+    """
+    LOG.info(f"Query datacube for datasets of {product_name} changed since {since}.")
+    return _search_index(product_name, product_config, since=since)
+
+
+def get_archived_dataset_uris(product_name, since=None):
+    """
+    Return the locations of the datasets of a product archived, or whose location was archived, since a point in time
+    """
+    from datacube import Datacube
+    from sqlalchemy import text
+
+    LOG.info(f"Query datacube for datasets of {product_name} archived since {since}.")
+    dc = Datacube(app='cog-worklist query')
+    with dc.index._db._engine.connect() as connection:  # pylint: disable=protected-access
+        return [row.uri for row in connection.execute(text(ARCHIVED_SEARCH_SQL), product=product_name, since=since)]
+
+
+# Values of the dataset documents needed by `filename_prefix_from_dataset` for `{x}`/`{y}` name templates
+# and for the time range, as PostgreSQL JSON paths.
+DOCUMENT_FIELDS = {
+    'ref_point_x': '{image,satellite_ref_point_start,x}',
+    'ref_point_y': '{image,satellite_ref_point_start,y}',
+    'geo_ref_x': '{grid_spatial,projection,geo_ref_points,ll,x}',
+    'geo_ref_y': '{grid_spatial,projection,geo_ref_points,ll,y}',
+    'center_dt': '{extent,center_dt}',
+    'from_dt': '{extent,from_dt}',
+    'to_dt': '{extent,to_dt}',
+}
+
+INDEX_SEARCH_SQL = """
+SELECT dataset_location.uri_scheme || ':' || dataset_location.uri_body AS uri,
+       COALESCE(dataset.updated, dataset.added) AS changed,
+       {columns}
+FROM agdc.dataset
+JOIN agdc.dataset_location ON dataset_location.dataset_ref = dataset.id AND dataset_location.archived IS NULL
+WHERE dataset.dataset_type_ref = (SELECT id FROM agdc.dataset_type WHERE name = :product)
+  AND dataset.archived IS NULL
+  AND COALESCE(dataset.updated, dataset.added) >= COALESCE(CAST(:since AS timestamptz), '-infinity')
+  AND tstzrange(
+        agdc.common_timestamp(COALESCE(dataset.metadata #>> '{{extent,from_dt}}',
+                                       dataset.metadata #>> '{{extent,center_dt}}')),
+        agdc.common_timestamp(COALESCE(dataset.metadata #>> '{{extent,to_dt}}',
+                                       dataset.metadata #>> '{{extent,center_dt}}')),
+        '[]') && tstzrange(CAST(:begin AS timestamptz), CAST(:end AS timestamptz), '[]')
+ORDER BY changed
+"""
+
+# GREATEST ignores NULLs, so this is the latest of the dataset's and the location's archival times
+ARCHIVED_SEARCH_SQL = """
+SELECT dataset_location.uri_scheme || ':' || dataset_location.uri_body AS uri
+FROM agdc.dataset
+JOIN agdc.dataset_location ON dataset_location.dataset_ref = dataset.id
+WHERE dataset.dataset_type_ref = (SELECT id FROM agdc.dataset_type WHERE name = :product)
+  AND GREATEST(dataset.archived, dataset_location.archived) >= COALESCE(CAST(:since AS timestamptz), '-infinity')
+"""
+
+
+def _search_index(product_name, product_config, since=None, time=None):
+    """
+    Search the datacube index tables directly, evaluating JSON paths in PostgreSQL
+
+    The datacube search API can neither filter on when datasets were indexed, nor return parts of
+    the dataset documents, so query the index tables. Only `lat`/`lon` name templates still need the
+    whole documents, to be read with the product's metadata type.
+
+    :param since: only return datasets added or updated since this time
+    :param time: only return datasets overlapping this time `Range`
+    :return: generator of (uri, basename, change time)
+    """
+    from datacube import Datacube
+    from sqlalchemy import text
+
+    dc = Datacube(app='cog-worklist query')
+    metadata_type = dc.index.products.get_by_name(product_name).metadata_type
+    field_names = get_field_names(product_config)
+    needs_document = 'lat' in field_names or 'lon' in field_names
+
+    columns = [f"dataset.metadata #>> '{path}' AS {name}" for name, path in DOCUMENT_FIELDS.items()]
+    if needs_document:
+        columns.append('dataset.metadata AS metadata_doc')
+    sql = INDEX_SEARCH_SQL.format(columns=',\n       '.join(columns))
+
+    params = dict(product=product_name, since=since,
+                  begin=time.begin if time is not None else None,
+                  end=time.end if time is not None else None)
+
+    with dc.index._db._engine.connect() as connection:  # pylint: disable=protected-access
+        for row in connection.execute(text(sql), **params):
+            ds_rec = _index_row_record(row, product_config, metadata_type if needs_document else None)
+            yield ds_rec.uri, filename_prefix_from_dataset(ds_rec, product_config), row.changed
+
+
+def _index_row_record(row, product_config, metadata_type=None):
+    """
+    Return a record of a row of `INDEX_SEARCH_SQL` with the attributes of a `search_returning` result,
+    as read by `filename_prefix_from_dataset`
+
+    :param metadata_type: metadata type reading ``lat``/``lon`` from the row's whole document, if they're needed
+    """
+    from psycopg2.extras import DateTimeTZRange
+
+    field_names = get_field_names(product_config)
+    ds_rec = SimpleNamespace(uri=row.uri)
+    if uses_document_fields(product_config):
+        for name in DOCUMENT_FIELDS:
+            setattr(ds_rec, name, getattr(row, name))
+    if 'time' in field_names:
+        # The type of the time search field, with the `lower` and `upper` bounds of the dataset's extent
+        ds_rec.time = DateTimeTZRange(dateutil.parser.parse(row.from_dt or row.center_dt),
+                                      dateutil.parser.parse(row.to_dt or row.center_dt), '[]')
+    if metadata_type is not None:
+        reader = metadata_type.dataset_reader(row.metadata_doc)
+        for name in ('lat', 'lon'):
+            if name in field_names:
+                setattr(ds_rec, name, getattr(reader, name))
+    return ds_rec
+
+
+def uses_document_fields(product_config):
+    """
+    Whether the name template of a product needs values from the dataset documents, rather than search fields
+    """
+    param_names = get_param_names(product_config['name_template'])
+    return 'x' in param_names or 'y' in param_names
+
+
 def get_field_names(product_config):
     """
-    Get field names for a datacube query for a given product
+    Get search field names for a datacube query for a given product
     """
 
     # Get parameter names
@@ -51,8 +192,6 @@ def get_field_names(product_config):
 
     # Populate field names
     field_names = ['uri']
-    if 'x' in param_names or 'y' in param_names:
-        field_names.append('metadata_doc')
     if 'time' in param_names or 'start_time' in param_names or 'end_time' in param_names:
         field_names.append('time')
     if 'lat' in param_names:
@@ -66,6 +205,8 @@ def validate_time_range(context, param, value):
     """
     Click callback to validate a date string
     """
+    from datacube.ui import parse_expressions
+
     try:
         parse_expressions(value)
         return value
@@ -76,14 +217,21 @@ def validate_time_range(context, param, value):
                                  "\n\t'time=2018-12-31'")
 
 
-def _convert_cog(product_config, in_filepath, output_prefix):
+def _convert_cog(product_config, in_filepath, output_prefix, metadata_only=False, context=None):
     """
     Convert a NetCDF file into a set of Cloud Optimise GeoTIFF files
 
     Uses a configuration dictionary to define the file naming schema.
+    With `metadata_only`, only the dataset YAML file is regenerated.
+    With a `ConversionContext`, its converter and open datasets are reused.
     """
-    convert_to_cog = NetCDFCOGConverter(**product_config)
-    convert_to_cog(in_filepath, output_prefix)
+    from dea_cogger.cogeo import NetCDFCOGConverter
+
+    if context is not None:
+        convert_to_cog = context.converter(product_config)
+    else:
+        convert_to_cog = NetCDFCOGConverter(**product_config)
+    convert_to_cog(in_filepath, output_prefix, metadata_only=metadata_only)
 
 
 def get_param_names(template_str):
@@ -101,13 +249,17 @@ def get_param_names(template_str):
     return set(re.findall(r'{([\w]+)[:YmdHMSf%]*}', template_str))
 
 
-def expected_bands(product_name):
+def expected_bands(product_name, product_config):
+    """
+    Return the names of the bands converted for a product, after applying its black and white lists
+    """
+    from datacube import Datacube
+    from dea_cogger.cogeo import BandSelection
+
     dc = Datacube(app='cog-worklist query')
     prod = dc.index.products.get_by_name(product_name)
-    available_measurements = set(prod.measurements.keys())
-    # TODO: Implement black and white listing
-    # Actually, maybe delete references to that since I don't believe it's used
-    return available_measurements
+    band_selection = BandSelection(product_config.get('black_list'), product_config.get('white_list'))
+    return set(band for band in prod.measurements.keys() if band_selection(band))
 
 
 def filename_prefix_from_dataset(result, product_config):
@@ -117,7 +269,18 @@ def filename_prefix_from_dataset(result, product_config):
     params = {}
 
     # Get geo x and y values
-    if hasattr(result, 'metadata_doc'):
+    if hasattr(result, 'geo_ref_x'):
+        # Values extracted from the dataset document by the database
+        if result.ref_point_x is not None:
+            # Process level2 scenes
+            params['x'] = f"{int(result.ref_point_x):03}"
+            params['y'] = f"{int(result.ref_point_y):03}"
+        else:
+            # Found netCDF files. Process them.
+            params['x'] = int(float(result.geo_ref_x) / 100000)
+            params['y'] = int(float(result.geo_ref_y) / 100000)
+        params['time'] = dateutil.parser.parse(result.center_dt)
+    elif hasattr(result, 'metadata_doc'):
         metadata = result.metadata_doc
         try:
             # Process level2 scenes
@@ -146,11 +309,143 @@ def filename_prefix_from_dataset(result, product_config):
     return basename
 
 
+def estimate_task_cost(input_file):
+    """
+    Cheaply estimate the cost of converting a NetCDF file
+
+    Uses a filesystem stat and the NetCDF header only, no data is read.
+
+    :return: tuple of (input bytes, pixels per band, band count). The pixel and band counts are
+             0 when the header can't be read.
+    """
+    # Strip the ODC #part=?? suffix
+    input_file = input_file.split('#')[0]
+
+    if is_remote(input_file):
+        return _estimate_remote_task_cost(input_file)
+
+    try:
+        input_bytes = os.stat(input_file).st_size
+    except OSError:
+        LOG.warning('Unable to stat input file', filepath=input_file)
+        return 0, 0, 0
+
+    try:
+        import netCDF4
+        with netCDF4.Dataset(input_file) as nco:
+            bands = [var for name, var in nco.variables.items()
+                     if var.ndim >= 2 and name != 'dataset' and name not in nco.dimensions]
+    except (ImportError, OSError):
+        return input_bytes, 0, 0
+
+    if not bands:
+        return input_bytes, 0, 0
+
+    pixels = bands[0].shape[-1] * bands[0].shape[-2]
+    return input_bytes, pixels, len(bands)
+
+
+def _estimate_remote_task_cost(input_file):
+    """
+    Estimate the cost of converting a remote NetCDF file from its size and header, read with ranged requests
+    """
+    import gdal
+
+    input_file = vsi_path(input_file)
+    stat = gdal.VSIStatL(input_file)
+    if stat is None:
+        LOG.warning('Unable to stat input file', filepath=input_file)
+        return 0, 0, 0
+
+    try:
+        # Skip the last subdataset, the dataset document
+        bands = gdal.Open(input_file, gdal.GA_ReadOnly).GetSubDatasets()[:-1]
+        band = gdal.Open(bands[0][0], gdal.GA_ReadOnly)
+    except (RuntimeError, IndexError):
+        return stat.size, 0, 0
+
+    return stat.size, band.RasterXSize * band.RasterYSize, len(bands)
+
+
+def is_remote(uri):
+    return uri.startswith(tuple(REMOTE_SCHEMES))
+
+
+def vsi_path(input_file):
+    """
+    Return the GDAL virtual file system path of an ``s3://`` or ``http(s)://`` URL, or a local path unchanged
+    """
+    for scheme, vsi_prefix in REMOTE_SCHEMES.items():
+        if input_file.startswith(scheme):
+            return vsi_prefix + input_file[len(scheme):]
+    return input_file
+
+
+def input_from_uri(uri):
+    """
+    Return the input file of a dataset location, a local path for ``file://`` URIs, otherwise the remote URL
+    """
+    if uri.startswith('file://'):
+        return uri[len('file://'):]
+    return uri
+
+
+def task_cost(input_bytes, pixels, band_count):
+    """
+    Single figure of merit for balancing tasks, falls back to the input size if the header wasn't readable
+    """
+    return pixels * band_count or input_bytes
+
+
+def shard_tasks(tasks, shards, cost=lambda task: 1):
+    """
+    Split tasks into `shards` lists with roughly equal total cost
+
+    Greedy longest-processing-time-first: the most expensive remaining task always goes
+    to the currently cheapest shard.
+    """
+    heap = [(0, i) for i in range(shards)]
+    sharded = [[] for _ in range(shards)]
+    for task in sorted(tasks, key=cost, reverse=True):
+        total, i = heapq.heappop(heap)
+        sharded[i].append(task)
+        heapq.heappush(heap, (total + cost(task), i))
+    return sharded
+
+
+def tasks_of_rank(tasks, rank, ranks):
+    """
+    Return the tasks of one of `ranks` workers, a contiguous slice of roughly equal length of the task list
+
+    The time slices of an input file, ``#part=N`` of the same file, all go to the same worker, which reads
+    them one after the other from the file it already has open.
+    """
+    by_input_file = {}
+    for task in tasks:
+        by_input_file.setdefault(task[0].split('#')[0], []).append(task)
+
+    # Each input file goes to the worker whose equal share of the tasks its first task falls in
+    start, end = len(tasks) * rank // ranks, len(tasks) * (rank + 1) // ranks
+    selected = []
+    first_task = 0
+    for file_tasks in by_input_file.values():
+        if start <= first_task < end:
+            selected.extend(file_tasks)
+        first_task += len(file_tasks)
+    return selected
+
+
 def _mpi_init():
     """
     Ensure we're running within a good MPI environment, and find out the number of processes we have.
+
+    Without MPI available, run as a single process.
     """
-    from mpi4py import MPI
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        LOG.info('MPI not available, running as a single process')
+        return 0, 1
     job_rank = MPI.COMM_WORLD.rank  # Rank of this process
     job_size = MPI.COMM_WORLD.size  # Total number of processes
     universe_size = MPI.COMM_WORLD.Get_attr(MPI.UNIVERSE_SIZE)
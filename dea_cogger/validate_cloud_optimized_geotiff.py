@@ -43,6 +43,22 @@ class ValidateCloudOptimizedGeoTIFFException(Exception):
     pass
 
 
+def get_block_offset(band):
+    """Return the offset of the first block of a band which is written.
+
+    Blocks left empty in a sparse file have no offset, and a band which
+    is entirely empty returns 0.
+    """
+    blockxsize, blockysize = band.GetBlockSize()
+    for y in range((band.YSize + blockysize - 1) // blockysize):
+        for x in range((band.XSize + blockxsize - 1) // blockxsize):
+            block_offset = band.GetMetadataItem(
+                'BLOCK_OFFSET_%d_%d' % (x, y), 'TIFF')
+            if block_offset:
+                return int(block_offset)
+    return 0
+
+
 def validate(ds, check_tiled=True):
     """Check if a file is a (Geo)TIFF with cloud optimized compatible structure.
 
@@ -146,20 +162,18 @@ def validate(ds, check_tiled=True):
 
     # Check that the imagery starts by the smallest overview and ends with
     # the main resolution dataset
-    block_offset = main_band.GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF')
-    if not block_offset:
-        errors += ['Missing BLOCK_OFFSET_0_0']
-    data_offset = int(block_offset) if block_offset else None
+    # Images without any written block (offset 0) are left out of the checks
+    data_offset = get_block_offset(main_band)
     data_offsets = [data_offset]
     details['data_offsets'] = {}
     details['data_offsets']['main'] = data_offset
     for i in range(ovr_count):
         ovr_band = ds.GetRasterBand(1).GetOverview(i)
-        data_offset = int(ovr_band.GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF'))
+        data_offset = get_block_offset(ovr_band)
         data_offsets.append(data_offset)
         details['data_offsets']['overview_%d' % i] = data_offset
 
-    if data_offsets[-1] < ifd_offsets[-1]:
+    if data_offsets[-1] != 0 and data_offsets[-1] < ifd_offsets[-1]:
         if ovr_count > 0:
             errors += [
                 'The offset of the first block of the smallest overview '
@@ -169,12 +183,13 @@ def validate(ds, check_tiled=True):
                 'The offset of the first block of the image should '
                 'be after its IFD']
     for i in range(len(data_offsets)-2, 0, -1):
-        if data_offsets[i] < data_offsets[i + 1]:
+        if data_offsets[i] != 0 and data_offsets[i] < data_offsets[i + 1]:
             errors += [
                 'The offset of the first block of overview of index %d should '
                 'be after the one of the overview of index %d' %
                 (i - 1, i)]
-    if len(data_offsets) >= 2 and data_offsets[0] < data_offsets[1]:
+    if len(data_offsets) >= 2 and data_offsets[0] != 0 and \
+            data_offsets[0] < data_offsets[1]:
         errors += [
             'The offset of the first block of the main resolution image'
             'should be after the one of the overview of index %d' %
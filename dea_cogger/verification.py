@@ -0,0 +1,306 @@
+"""
+Helpers for checking converted GeoTIFFs are valid Cloud Optimised GeoTIFFs
+"""
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import structlog
+from botocore.exceptions import ClientError
+
+from dea_cogger.aws_s3_client import s3_fetch_range
+
+LOG = structlog.get_logger()
+
+GEOTIFF_SUFFIXES = ('.tif', '.tiff')
+
+# Size of the first ranged read of a remote GeoTIFF, enough to cover the IFDs of a typical COG
+REMOTE_HEADER_BYTES = 64 * 1024
+
+# Smallest later ranged read, so an IFD and the values it points to are usually fetched together
+REMOTE_READ_BYTES = 16 * 1024
+
+# TIFF tags and field types needed to check the COG layout
+TAG_NEW_SUBFILE_TYPE = 254
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_STRIP_OFFSETS = 273
+TAG_TILE_WIDTH = 322
+TAG_TILE_OFFSETS = 324
+BLOCK_OFFSET_TAGS = (TAG_STRIP_OFFSETS, TAG_TILE_OFFSETS)
+SUBFILE_REDUCED_IMAGE = 1
+SUBFILE_MASK = 4
+FIELD_FORMATS = {1: 'B', 3: 'H', 4: 'L', 16: 'Q'}
+
+
+def iter_geotiffs(path):
+    """
+    Lazily walk a directory tree, yielding ``(geotiff_path, has_yaml)`` for every GeoTIFF found
+
+    Each directory is scanned once, so the presence of a dataset YAML is checked once per
+    dataset directory instead of once per band.
+    """
+    directories = [str(path)]
+    while directories:
+        directory = directories.pop()
+        geotiffs = []
+        has_yaml = False
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.lower().endswith(GEOTIFF_SUFFIXES):
+                    geotiffs.append(entry.path)
+                elif entry.name.endswith('.yaml'):
+                    has_yaml = True
+
+        for geotiff in sorted(geotiffs):
+            yield Path(geotiff), has_yaml
+
+
+def iter_listed_geotiffs(filenames):
+    """
+    Yield ``(geotiff_path, has_yaml)`` for a list of GeoTIFF filenames, checking each directory once
+    """
+    yaml_dirs = {}
+    for filename in filenames:
+        geotiff = Path(filename)
+        directory = geotiff.parent
+        if directory not in yaml_dirs:
+            try:
+                yaml_dirs[directory] = any(name.endswith('.yaml') for name in os.listdir(directory))
+            except OSError:
+                # A missing directory has no YAML, so its GeoTIFFs are reported as broken
+                LOG.warning('Unable to list directory', directory=str(directory))
+                yaml_dirs[directory] = False
+        yield geotiff, yaml_dirs[directory]
+
+
+def validate_geotiff(geotiff):
+    """
+    Validate a single GeoTIFF in process, returning ``(geotiff, errors)``
+
+    An empty list of errors means the file is a valid COG.
+    """
+    from dea_cogger.validate_cloud_optimized_geotiff import validate, ValidateCloudOptimizedGeoTIFFException
+
+    try:
+        errors, _ = validate(str(geotiff))
+    except ValidateCloudOptimizedGeoTIFFException as exc:
+        errors = [str(exc)]
+    return geotiff, errors
+
+
+class VerifiedCache:
+    """
+    Record of GeoTIFFs which have already been verified, keyed by path, size and modification time
+
+    Stored as a tab separated text file, a file that's been rewritten since it was verified no longer matches.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.verified = set()
+        self.new_entries = []
+        if filename is not None and Path(filename).exists():
+            with open(filename) as fin:
+                self.verified = set(tuple(line.rstrip('\n').split('\t')) for line in fin)
+
+    @staticmethod
+    def _key(geotiff):
+        stat = os.stat(geotiff)
+        return str(geotiff), str(stat.st_size), str(stat.st_mtime_ns)
+
+    def __contains__(self, geotiff):
+        if self.filename is None:
+            return False
+        try:
+            return self._key(geotiff) in self.verified
+        except OSError:
+            return False
+
+    def add(self, geotiff):
+        if self.filename is not None:
+            self.new_entries.append(self._key(geotiff))
+
+    def save(self, entries=None):
+        """
+        Append newly verified entries, optionally gathered from other processes, to the cache file
+        """
+        if self.filename is None:
+            return
+        entries = self.new_entries if entries is None else entries
+        with open(self.filename, 'a') as fout:
+            for entry in entries:
+                fout.write('\t'.join(entry) + '\n')
+        LOG.info('Updated verified GeoTIFF cache', filename=self.filename, new_entries=len(entries))
+
+
+class RemoteTIFFException(Exception):
+    pass
+
+
+class _RangeReader:
+    """
+    Read parts of a remote object, fetching only the ranges read which aren't already fetched
+    """
+
+    def __init__(self, url, s3, initial_bytes=REMOTE_HEADER_BYTES):
+        self.url = url
+        self.s3 = s3
+        self.ranges = [(0, s3_fetch_range(url, 0, initial_bytes, s3=s3))]
+        self.requests = 1
+        self.bytes_read = len(self.ranges[0][1])
+
+    def read(self, offset, size):
+        for start, data in self.ranges:
+            if start <= offset and offset + size <= start + len(data):
+                return data[offset - start:offset - start + size]
+
+        data = s3_fetch_range(self.url, offset, offset + max(size, REMOTE_READ_BYTES), s3=self.s3)
+        self.requests += 1
+        self.bytes_read += len(data)
+        if len(data) < size:
+            raise RemoteTIFFException(f'Read past end of file at byte {offset + size}')
+        self.ranges.append((offset, data))
+        return data[:size]
+
+
+def _read_ifds(reader):
+    """
+    Parse the chain of IFDs of a (Big)TIFF, returning a list of ``(ifd_offset, tags)``
+
+    Only the first value of each tag is kept, which is all the COG layout checks need, except for the
+    block offsets: empty blocks of a sparse file have an offset of 0, so the first non-zero one is kept,
+    or 0 when no block is written.
+
+    Fails straight away unless the main IFD follows the header, as in a COG, instead of following
+    the IFDs of a file which isn't one, eg. to the end of it.
+    """
+    byte_order = {b'II': '<', b'MM': '>'}.get(reader.read(0, 2))
+    if byte_order is None:
+        raise RemoteTIFFException('The file is not a TIFF')
+
+    version, = struct.unpack(byte_order + 'H', reader.read(2, 2))
+    if version == 42:
+        offset, = struct.unpack(byte_order + 'L', reader.read(4, 4))
+        count_fmt, entry_size, offset_fmt = 'H', 12, 'L'
+    elif version == 43:
+        offset, = struct.unpack(byte_order + 'Q', reader.read(8, 8))
+        count_fmt, entry_size, offset_fmt = 'Q', 20, 'Q'
+    else:
+        raise RemoteTIFFException('The file is not a TIFF')
+
+    if offset not in (8, 16):
+        raise RemoteTIFFException(f'The offset of the main IFD should be 8 for ClassicTIFF or 16 for BigTIFF. '
+                                  f'It is {offset} instead')
+
+    count_size = struct.calcsize(byte_order + count_fmt)
+    offset_size = struct.calcsize(byte_order + offset_fmt)
+    ifds = []
+    while offset:
+        if len(ifds) > 64:
+            raise RemoteTIFFException('Too many IFDs, the IFD chain may be circular')
+
+        n_entries, = struct.unpack(byte_order + count_fmt, reader.read(offset, count_size))
+        entries = reader.read(offset + count_size, n_entries * entry_size + offset_size)
+
+        tags = {}
+        for i in range(n_entries):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            tag, field_type = struct.unpack(byte_order + 'HH', entry[:4])
+            value_fmt = FIELD_FORMATS.get(field_type)
+            if value_fmt is None:
+                continue
+            # Value counts and offsets share a size, 4 bytes for ClassicTIFF or 8 for BigTIFF
+            count, = struct.unpack(byte_order + offset_fmt, entry[4:4 + offset_size])
+            value_bytes = entry[4 + offset_size:]
+            value_len = struct.calcsize(byte_order + value_fmt)
+            n_values = count if tag in BLOCK_OFFSET_TAGS else 1
+            if count * value_len > offset_size:
+                # The values don't fit in the entry, it holds an offset to them instead
+                values_offset, = struct.unpack(byte_order + offset_fmt, value_bytes)
+                value_bytes = reader.read(values_offset, n_values * value_len)
+            values = struct.unpack(byte_order + value_fmt * n_values, value_bytes[:n_values * value_len])
+            tags[tag] = next((value for value in values if value), 0) if tag in BLOCK_OFFSET_TAGS else values[0]
+
+        ifds.append((offset, tags))
+        offset, = struct.unpack(byte_order + offset_fmt, entries[n_entries * entry_size:])
+
+    return ifds
+
+
+def validate_remote_geotiff(url, s3):
+    """
+    Check the COG layout of a GeoTIFF on S3 using ranged reads of its header, returning ``(url, errors)``
+
+    Applies the same IFD and data ordering checks as `validate_cloud_optimized_geotiff`, without
+    downloading the image data.
+    """
+    try:
+        reader = _RangeReader(url, s3)
+        ifds = _read_ifds(reader)
+    except (RemoteTIFFException, ClientError, struct.error) as exc:
+        return url, [str(exc)]
+
+    if not ifds:
+        return url, ['No IFD found']
+
+    # Keep the main image and its overviews, skipping masks
+    images = [(offset, tags) for offset, tags in ifds if not tags.get(TAG_NEW_SUBFILE_TYPE, 0) & SUBFILE_MASK]
+    (_, main_tags), overviews = images[0], images[1:]
+
+    errors = []
+    width, height = main_tags.get(TAG_IMAGE_WIDTH, 0), main_tags.get(TAG_IMAGE_LENGTH, 0)
+    if width >= 512 or height >= 512:
+        if TAG_TILE_WIDTH not in main_tags and width > 1024:
+            errors.append('The file is greater than 512xH or Wx512, but is not tiled')
+        if not overviews:
+            errors.append('The file is greater than 512xH or Wx512, but has no overviews')
+
+    previous = main_tags
+    for i, (_, tags) in enumerate(overviews):
+        if not tags.get(TAG_NEW_SUBFILE_TYPE, 0) & SUBFILE_REDUCED_IMAGE:
+            errors.append(f'IFD of overview of index {i} is not flagged as a reduced resolution image')
+        larger = [tags.get(tag, 0) > previous.get(tag, 0) for tag in (TAG_IMAGE_WIDTH, TAG_IMAGE_LENGTH)]
+        if any(larger):
+            errors.append(f'Overview of index {i} has larger dimension than the previous image')
+        previous = tags
+
+    ifd_offsets = [offset for offset, _ in images]
+    if ifd_offsets != sorted(ifd_offsets):
+        errors.append('The IFDs of the overviews are not sorted by increasing offsets')
+
+    data_offsets = [tags.get(TAG_TILE_OFFSETS, tags.get(TAG_STRIP_OFFSETS)) for _, tags in images]
+    if None in data_offsets:
+        errors.append('Missing tile offsets')
+    else:
+        # Images without any written block are left out of the ordering checks
+        if 0 < data_offsets[-1] < ifd_offsets[-1]:
+            errors.append('The offset of the first block of the smallest overview should be after its IFD')
+        written_offsets = [offset for offset in data_offsets if offset]
+        if written_offsets != sorted(written_offsets, reverse=True):
+            errors.append('The imagery should start with the smallest overview and end with the main image')
+
+    LOG.debug('Checked remote GeoTIFF', url=url, range_requests=reader.requests, bytes_read=reader.bytes_read)
+    return url, errors
+
+
+def validate_remote_geotiffs(urls, s3, concurrency=32):
+    """
+    Check many remote GeoTIFFs concurrently over a shared S3 client, yielding ``(url, errors)``
+
+    At most a few requests per worker are queued at once, so `urls` can be a long, lazy iterable.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set()
+        for url in urls:
+            pending.add(executor.submit(validate_remote_geotiff, url, s3))
+            if len(pending) >= 4 * concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        for future in pending:
+            yield future.result()
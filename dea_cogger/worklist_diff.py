@@ -0,0 +1,98 @@
+"""
+Find the datasets not yet uploaded by merge-joining sorted streams, in bounded memory
+
+The default work list generation loads every inventory key into a set and probes it for each expected
+output. Here the datacube results and the inventory keys are both reduced to lines keyed by output
+basename, sorted externally in runs spilled to temporary files, and joined in a single ordered pass,
+so memory use doesn't grow with the size of the inventory.
+
+Lines are ``basename<TAB>value``. A tab sorts before any character of a key, so the lines sort in
+the same order as their basenames alone.
+"""
+import heapq
+import tempfile
+from itertools import groupby, islice
+
+# Lines held in memory per sorted run
+SORT_RUN_LINES = 1000000
+
+
+def external_sort(lines, run_lines=SORT_RUN_LINES, tmp_dir=None):
+    """
+    Lazily sort an iterable of text lines, without newlines, holding at most `run_lines` of them in memory
+    """
+    lines = iter(lines)
+    runs = []
+    try:
+        while True:
+            run = list(islice(lines, run_lines))
+            if not run:
+                break
+            run.sort()
+            run_file = tempfile.TemporaryFile('w+', dir=tmp_dir)
+            run_file.writelines(line + '\n' for line in run)
+            run_file.seek(0)
+            runs.append(run_file)
+            del run
+
+        for line in heapq.merge(*runs):
+            yield line[:-1]
+    finally:
+        for run_file in runs:
+            run_file.close()
+
+
+def output_suffixes(bands, multi_band=False):
+    """
+    Return the suffixes of the output keys of a dataset, appended to its basename
+    """
+    if multi_band:
+        return {'.yaml', '.tif'}
+    return {'.yaml'} | {f'_{band}.tif' for band in bands}
+
+
+def inventory_output_lines(keys, suffixes):
+    """
+    Yield a ``basename<TAB>suffix`` line for each inventory key which could be an output, ignoring the rest
+
+    A key ending with several of the suffixes, when one band name ends with another, yields a line for
+    each, only the one with the right basename will ever be joined.
+    """
+    for key in keys:
+        key = key.strip()
+        for suffix in suffixes:
+            if key.endswith(suffix):
+                yield f'{key[:-len(suffix)]}\t{suffix}'
+
+
+def dataset_lines(dataset_values):
+    """
+    Yield a ``basename<TAB>uri`` line for each ``(uri, basename)`` of the datacube results
+    """
+    for uri, basename in dataset_values:
+        yield f'{basename}\t{uri}'
+
+
+def _split(lines):
+    return (line.split('\t', 1) for line in lines)
+
+
+def merge_diff(sorted_dataset_lines, sorted_output_lines, suffixes):
+    """
+    Merge-join sorted dataset and inventory lines, yielding ``(uri, basename)`` of the datasets missing an output
+
+    When several datasets share a basename, only the last one in sorted order is kept, as the set-based
+    diff keeps only one.
+    """
+    outputs = ((basename, set(suffix for _, suffix in group))
+               for basename, group in groupby(_split(sorted_output_lines), key=lambda pair: pair[0]))
+    output_basename, present = next(outputs, (None, set()))
+
+    for basename, group in groupby(_split(sorted_dataset_lines), key=lambda pair: pair[0]):
+        *_, (_, uri) = group
+
+        while output_basename is not None and output_basename < basename:
+            output_basename, present = next(outputs, (None, set()))
+
+        if output_basename != basename or not suffixes <= present:
+            yield uri, basename
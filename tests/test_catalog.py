@@ -0,0 +1,47 @@
+"""
+Conversion states of the datasets in the SQLite catalog
+"""
+from datetime import datetime, timezone
+
+import pytest
+
+from dea_cogger.catalog import ConversionCatalog, profile_hash, whole_config_hash
+
+CONFIG = {'prefix': 'WOfS/WOFLs/v2.1.5/combined', 'name_template': 'x_{x}/y_{y}/LS_WATER_3577_{x}_{y}',
+          'default_resampling': 'nearest'}
+CHANGED = datetime(2019, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    with ConversionCatalog(tmp_path / 'catalog.db') as conversion_catalog:
+        for dataset_no in range(3):
+            conversion_catalog.add('wofs', f'file:///{dataset_no}.nc', f'x_1/y_1/{dataset_no}', profile_hash(CONFIG),
+                                   CHANGED)
+        yield conversion_catalog
+
+
+def test_profile_hash_only_output_options():
+    assert profile_hash(CONFIG) == profile_hash(dict(CONFIG, prefix='WOfS/WOFLs/v2.1.6/combined'))
+    assert profile_hash(CONFIG) != profile_hash(dict(CONFIG, default_resampling='average'))
+
+
+def test_reprofile(catalog):
+    catalog.mark_uploaded(['file:///0.nc', 'file:///1.nc'])
+
+    catalog.reprofile('wofs', profile_hash(dict(CONFIG, name_template='{x}_{y}')))
+    assert catalog.stale('wofs') == []
+
+    catalog.reprofile('wofs', profile_hash(dict(CONFIG, predictor=3)))
+    assert sorted(uri for uri, _, _ in catalog.stale('wofs')) == ['file:///0.nc', 'file:///1.nc']
+    # Never converted, any outputs will still do
+    assert catalog.pending('wofs') == [('file:///2.nc', 'x_1/y_1/2')]
+
+
+def test_reprofile_earlier_hash(catalog):
+    # Datasets recorded by an earlier version, which hashed the whole configuration
+    catalog.db.execute('UPDATE dataset SET profile_hash = ?', (whole_config_hash(CONFIG),))
+    catalog.mark_uploaded(['file:///0.nc'])
+
+    catalog.reprofile('wofs', profile_hash(CONFIG), [whole_config_hash(CONFIG)])
+    assert catalog.stale('wofs') == []
@@ -0,0 +1,135 @@
+"""
+Round trip rasters through `cog_translate`
+"""
+import numpy
+import pytest
+
+gdal = pytest.importorskip('gdal')
+rasterio = pytest.importorskip('rasterio')
+
+from rasterio.transform import from_origin  # noqa: E402
+
+from dea_cogger.cogeo import DEFAULT_PROFILE, COGException, DatasetCache, NetCDFCOGConverter, _gdal_data_type, \
+    _stack_bands, cog_translate, cog_translate_gdal  # noqa: E402
+from dea_cogger.verification import validate_geotiff  # noqa: E402
+
+NODATA = -999
+
+
+@pytest.fixture
+def mostly_nodata_source(tmp_path):
+    """
+    A WOfS like tile, nodata apart from a patch in the bottom right, so the top left block of the
+    image and of its first overview are empty
+    """
+    data = numpy.full((1500, 2000), NODATA, dtype='int16')
+    data[1100:1400, 900:1700] = numpy.random.RandomState(0).randint(0, 255, size=(300, 800))
+
+    path = tmp_path / 'source.tif'
+    with rasterio.open(path, 'w', driver='GTiff', width=2000, height=1500, count=1, dtype='int16',
+                       nodata=NODATA, crs='EPSG:3577', transform=from_origin(1500000, -3900000, 25, 25),
+                       tiled=True, blockxsize=256, blockysize=256) as dst:
+        dst.write(data, 1)
+    return str(path)
+
+
+@pytest.fixture
+def blocky_source(tmp_path):
+    """
+    A source constant over every aligned 4x4 window, with nodata patches, so any resampling of its 2x and 4x
+    overviews gives the same pixels, whichever level they're computed from
+    """
+    random = numpy.random.RandomState(0)
+    cells = random.randint(0, 10000, size=(1500 // 4, 2000 // 4)).astype('int16')
+    cells[:30, :60] = NODATA
+    cells[random.rand(*cells.shape) < 0.05] = NODATA
+    data = numpy.kron(cells, numpy.ones((4, 4), dtype='int16'))
+
+    path = tmp_path / 'blocky.tif'
+    with rasterio.open(path, 'w', driver='GTiff', width=2000, height=1500, count=1, dtype='int16',
+                       nodata=NODATA, crs='EPSG:3577', transform=from_origin(1500000, -3900000, 25, 25),
+                       tiled=True, blockxsize=256, blockysize=256) as dst:
+        dst.write(data, 1)
+    return str(path)
+
+
+def _read_pyramid(path):
+    band = gdal.Open(path).GetRasterBand(1)
+    return [band.ReadAsArray()] + [band.GetOverview(i).ReadAsArray() for i in range(band.GetOverviewCount())]
+
+
+def test_sparse_round_trip(mostly_nodata_source, tmp_path):
+    outputs = {}
+    for sparse in (False, True):
+        dst_path = str(tmp_path / f'sparse_{sparse}.tif')
+        profile = dict(DEFAULT_PROFILE, predictor=2)
+        if sparse:
+            profile['sparse_ok'] = True
+        cog_translate(mostly_nodata_source, dst_path, profile, indexes=[1], overview_resampling='nearest',
+                      sparse=sparse)
+        outputs[sparse] = dst_path
+
+    dense, sparse = _read_pyramid(outputs[False]), _read_pyramid(outputs[True])
+    assert len(dense) == len(sparse) > 1
+    for dense_level, sparse_level in zip(dense, sparse):
+        numpy.testing.assert_array_equal(dense_level, sparse_level)
+
+    # Empty blocks, including the top left ones, don't make a valid COG look broken
+    band = gdal.Open(outputs[True]).GetRasterBand(1)
+    assert not band.GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF')
+    for path in outputs.values():
+        assert validate_geotiff(path)[1] == []
+
+
+@pytest.mark.parametrize('dtype, data_type', [('uint8', gdal.GDT_Byte), ('int16', gdal.GDT_Int16),
+                                              ('float64', gdal.GDT_Float64), ('complex64', gdal.GDT_CFloat32)])
+def test_gdal_data_type(dtype, data_type):
+    assert _gdal_data_type(dtype) == data_type
+
+
+def test_unsupported_data_type():
+    # A rasterio only dtype name, with no numpy equivalent
+    with pytest.raises(COGException, match='complex_int16'):
+        _gdal_data_type('complex_int16')
+
+
+def test_multi_band_cog_engine():
+    with pytest.raises(COGException, match='gtiff engine'):
+        NetCDFCOGConverter(engine='cog', multi_band=True)
+
+
+def test_dataset_cache_retain(mostly_nodata_source, tmp_path):
+    datasets = DatasetCache()
+    datasets.gdal_open(mostly_nodata_source)
+    # A band of another file, standing in for an open subdataset
+    datasets._get(('gdal', f'NETCDF:"{tmp_path}/stacked.nc":BS'), object)
+    datasets.rasterio_open(mostly_nodata_source)
+
+    datasets.retain(f'{tmp_path}/stacked.nc')
+    assert list(datasets.datasets) == [('gdal', f'NETCDF:"{tmp_path}/stacked.nc":BS')]
+
+
+def test_stack_no_bands(tmp_path):
+    with pytest.raises(COGException, match='No bands'):
+        _stack_bands(str(tmp_path / 'stacked.vrt'), [], 1)
+
+
+@pytest.mark.skipif(int(gdal.VersionInfo('VERSION_NUM')) < 3010000, reason='The COG driver needs GDAL 3.1')
+@pytest.mark.parametrize('resampling', ['nearest', 'average'])
+def test_engines_match(blocky_source, tmp_path, resampling):
+    outputs = {}
+    for name, engine in (('gtiff', cog_translate), ('cog', cog_translate_gdal)):
+        outputs[name] = str(tmp_path / f'{name}.tif')
+        engine(blocky_source, outputs[name], dict(DEFAULT_PROFILE, predictor=2), indexes=[1],
+               overview_resampling=resampling)
+
+    gtiff, cog = _read_pyramid(outputs['gtiff']), _read_pyramid(outputs['cog'])
+    assert len(gtiff) == len(cog) == 3
+    for gtiff_level, cog_level in zip(gtiff, cog):
+        numpy.testing.assert_array_equal(gtiff_level, cog_level)
+
+    gtiff, cog = gdal.Open(outputs['gtiff']), gdal.Open(outputs['cog'])
+    assert gtiff.GetGeoTransform() == cog.GetGeoTransform()
+    assert gtiff.GetRasterBand(1).GetNoDataValue() == cog.GetRasterBand(1).GetNoDataValue() == NODATA
+    for path in outputs.values():
+        assert validate_geotiff(path)[1] == []
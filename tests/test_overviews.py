@@ -0,0 +1,74 @@
+"""
+Compare the overview levels accumulated from full resolution blocks with GDAL's own resampling
+"""
+from collections import namedtuple
+
+import numpy
+import pytest
+
+from dea_cogger.overviews import OverviewPyramid, overview_factors
+
+Window = namedtuple('Window', 'col_off row_off width height')
+
+WIDTH, HEIGHT, BLOCKSIZE = 1024, 1536, 512
+NODATA = -999
+
+
+def test_overview_factors():
+    assert overview_factors(512, 512) == []
+    assert overview_factors(513, 100) == [2]
+    assert overview_factors(WIDTH, HEIGHT) == [2, 4]
+    assert overview_factors(4000, 4000, overview_level=2) == [2, 4]
+
+
+def _pyramid(data, resampling):
+    factors = overview_factors(WIDTH, HEIGHT, BLOCKSIZE)
+    pyramid = OverviewPyramid(WIDTH, HEIGHT, 1, data.dtype, factors, resampling, nodata=NODATA)
+    for row_off in range(0, HEIGHT, BLOCKSIZE):
+        for col_off in range(0, WIDTH, BLOCKSIZE):
+            pyramid.add_block(Window(col_off, row_off, BLOCKSIZE, BLOCKSIZE),
+                              data[None, row_off:row_off + BLOCKSIZE, col_off:col_off + BLOCKSIZE])
+    return pyramid
+
+
+def _gdal_overview(data, factor, resampling):
+    gdal = pytest.importorskip('gdal')
+
+    mem = gdal.GetDriverByName('MEM')
+    base = mem.Create('', WIDTH, HEIGHT, 1, gdal.GDT_Int16)
+    base.GetRasterBand(1).WriteArray(data)
+    base.GetRasterBand(1).SetNoDataValue(NODATA)
+
+    overview = mem.Create('', WIDTH // factor, HEIGHT // factor, 1, gdal.GDT_Int16)
+    overview.GetRasterBand(1).SetNoDataValue(NODATA)
+    gdal.RegenerateOverview(base.GetRasterBand(1), overview.GetRasterBand(1), resampling.upper())
+    return overview.GetRasterBand(1).ReadAsArray()
+
+
+def _random_data(seed=0):
+    data = numpy.random.RandomState(seed).randint(0, 10000, size=(HEIGHT, WIDTH)).astype('int16')
+    data[:100, :300] = NODATA
+    data[::7, ::5] = NODATA
+    return data
+
+
+def _majority_data(seed=0):
+    """
+    Categories constant over each 4x4 window except for one pixel, so every window has a unique mode
+    """
+    random = numpy.random.RandomState(seed)
+    data = numpy.kron(random.randint(0, 5, size=(HEIGHT // 4, WIDTH // 4)), numpy.ones((4, 4))).astype('int16')
+    data[::4, ::4] = random.randint(0, 5, size=(HEIGHT // 4, WIDTH // 4))
+    return data
+
+
+@pytest.mark.parametrize('resampling, data, tolerance', [
+    ('nearest', _random_data(), 0),
+    ('average', _random_data(), 1),
+    ('mode', _majority_data(), 0),
+])
+def test_matches_gdal(resampling, data, tolerance):
+    pyramid = _pyramid(data, resampling)
+    for factor, level in zip(pyramid.factors, pyramid.levels):
+        expected = _gdal_overview(data, factor, resampling)
+        assert numpy.abs(level[0].astype('int32') - expected).max() <= tolerance
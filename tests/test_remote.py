@@ -0,0 +1,105 @@
+"""
+Read a NetCDF input from a local HTTP server with ranged requests, as an https:// dataset location is read
+"""
+import os
+import threading
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import numpy
+import pytest
+
+pytest.importorskip('gdal')
+netCDF4 = pytest.importorskip('netCDF4')
+
+from dea_cogger.cogeo import _read_dataset_doc  # noqa: E402
+from dea_cogger.utils import estimate_task_cost, vsi_path  # noqa: E402
+
+DATASET_DOC = 'id: 4f3fc3a8-7e2d-4d5e-9b8b-0c1a6f8d2e11\nimage:\n  bands: {}\n'
+BANDS = ('BS', 'PV', 'NPV')
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file server answering ``Range: bytes=start-stop`` requests, recording the ranges asked for
+    """
+
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if range_header is None or not os.path.isfile(path):
+            super().do_GET()
+            return
+
+        size = os.path.getsize(path)
+        start, stop = range_header.split('=', 1)[1].split('-')
+        start, stop = int(start), min(int(stop) if stop else size - 1, size - 1)
+        self.server.ranges.append((start, stop))
+
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Range', f'bytes {start}-{stop}/{size}')
+        self.send_header('Content-Length', str(stop - start + 1))
+        self.end_headers()
+        with open(path, 'rb') as fin:
+            fin.seek(start)
+            self.wfile.write(fin.read(stop - start + 1))
+
+    def end_headers(self):
+        if self.command == 'HEAD':
+            self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_dir(tmp_path):
+    """
+    Serve `tmp_path` over HTTP, yielding ``(url, server)``
+    """
+    server = HTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=str(tmp_path)))
+    server.ranges = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}', server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def write_netcdf(filename, times=2, size=300):
+    """
+    A stacked NetCDF file laid out as the ODC writes them, bands first and the dataset documents last
+    """
+    with netCDF4.Dataset(filename, 'w') as nco:
+        nco.createDimension('time', times)
+        nco.createDimension('y', size)
+        nco.createDimension('x', size)
+        nco.createDimension('string', 128)
+        for band in BANDS:
+            variable = nco.createVariable(band, 'int16', ('time', 'y', 'x'), zlib=True, chunksizes=(1, 100, 100))
+            variable[:] = numpy.arange(times * size * size, dtype='int32').reshape(times, size, size) % 100
+        dataset = nco.createVariable('dataset', 'S1', ('time', 'string'))
+        for time_index in range(times):
+            doc = DATASET_DOC.replace('bands', f'bands_{time_index}').encode('utf8')
+            dataset[time_index] = netCDF4.stringtochar(numpy.array([doc], dtype='S128'))
+
+
+def test_read_remote(http_dir, tmp_path):
+    url, server = http_dir
+    write_netcdf(tmp_path / 'stacked.nc')
+
+    input_file = vsi_path(f'{url}/stacked.nc')
+    assert input_file.startswith('/vsicurl/http://')
+    assert _read_dataset_doc(input_file, 1) == DATASET_DOC.replace('bands', 'bands_1')
+
+    input_bytes, pixels, band_count = estimate_task_cost(f'{url}/stacked.nc')
+    assert input_bytes == (tmp_path / 'stacked.nc').stat().st_size
+    assert (pixels, band_count) == (300 * 300, len(BANDS))
+
+    # Read with ranged requests, rather than downloading the whole file
+    assert server.ranges
@@ -0,0 +1,89 @@
+"""
+Work list helpers which don't need a datacube index or GDAL
+"""
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import yaml
+
+from dea_cogger.utils import DOCUMENT_FIELDS, _index_row_record, filename_prefix_from_dataset, input_from_uri, \
+    is_remote, tasks_of_rank, vsi_path
+
+PRODUCTS = yaml.safe_load((Path(__file__).parent.parent / 'dea_cogger' / 'aws_products_config.yaml').read_text())[
+    'products']
+
+
+@pytest.fixture
+def psycopg2():
+    # The time search field type
+    return pytest.importorskip('psycopg2')
+
+
+def _index_row(**values):
+    """
+    A row of `INDEX_SEARCH_SQL` for an albers tile, the JSON values all come back as text
+    """
+    row = dict.fromkeys(DOCUMENT_FIELDS)
+    row.update(uri='file:///g/data/tile.nc', changed=None,
+               geo_ref_x='1500000.0', geo_ref_y='-3900000.0', center_dt='2018-05-06T10:20:18.123456')
+    row.update(values)
+    return SimpleNamespace(**row)
+
+
+def test_index_row_with_time(psycopg2):
+    product_config = PRODUCTS['wofs_albers']
+    record = _index_row_record(_index_row(), product_config)
+    assert filename_prefix_from_dataset(record, product_config) == (
+        'WOfS/WOFLs/v2.1.5/combined/x_15/y_-39/2018/05/06/LS_WATER_3577_15_-39_20180506102018123456')
+
+
+def test_index_row_with_start_and_end_time(psycopg2):
+    product_config = PRODUCTS['fc_percentile_seasonal']
+    row = _index_row(center_dt='2017-10-16T00:00:00', from_dt='2017-09-01T00:00:00', to_dt='2017-11-30T23:59:59')
+    record = _index_row_record(row, product_config)
+    assert filename_prefix_from_dataset(record, product_config) == (
+        'fractional-cover/fc-percentile/seasonal/v2.1.0/combined/x_15/y_-39/LS_FC_PC_3577_15_-39_20170901_20171130')
+
+
+def test_index_row_scene(psycopg2):
+    # Level 2 scenes are named by their path and row
+    product_config = {'prefix': 'L2', 'name_template': '{x}_{y}/{time:%Y%m%d}'}
+    record = _index_row_record(_index_row(ref_point_x=90, ref_point_y=84), product_config)
+    assert filename_prefix_from_dataset(record, product_config) == 'L2/090_084/20180506'
+
+
+@pytest.mark.parametrize('uri, path', [
+    ('s3://dea-public-data/fc/LS8_FC.nc', '/vsis3/dea-public-data/fc/LS8_FC.nc'),
+    ('https://data.dea.ga.gov.au/fc/LS8_FC.nc', '/vsicurl/https://data.dea.ga.gov.au/fc/LS8_FC.nc'),
+    ('http://localhost:8000/LS8_FC.nc', '/vsicurl/http://localhost:8000/LS8_FC.nc'),
+    ('/g/data/fc/LS8_FC.nc', '/g/data/fc/LS8_FC.nc'),
+])
+def test_vsi_path(uri, path):
+    assert vsi_path(uri) == path
+    assert is_remote(uri) == (path != uri)
+
+
+@pytest.mark.parametrize('uri, input_file', [
+    ('file:///g/data/fc/LS8_FC.nc#part=3', '/g/data/fc/LS8_FC.nc#part=3'),
+    ('s3://dea-public-data/fc/LS8_FC.nc', 's3://dea-public-data/fc/LS8_FC.nc'),
+])
+def test_input_from_uri(uri, input_file):
+    assert input_from_uri(uri) == input_file
+
+
+def test_tasks_of_rank():
+    tasks = [(f'/g/data/fc/{file_no}.nc#part={part}', f'{file_no}_{part}') for file_no in range(5)
+             for part in range(3)]
+    # A later time slice of the first file, listed out of order
+    tasks.append(('/g/data/fc/0.nc#part=3', '0_3'))
+
+    ranks = [tasks_of_rank(tasks, rank, 3) for rank in range(3)]
+    assert sorted(task for rank_tasks in ranks for task in rank_tasks) == sorted(tasks)
+    assert [len(rank_tasks) for rank_tasks in ranks] == [7, 3, 6]
+    assert [task[1] for task in ranks[0]] == ['0_0', '0_1', '0_2', '0_3', '1_0', '1_1', '1_2']
+
+
+def test_tasks_of_rank_more_ranks_than_files():
+    tasks = [('s3://dea-public-data/fc/0.nc#part=0', '0_0'), ('s3://dea-public-data/fc/0.nc#part=1', '0_1')]
+    assert sorted(tasks_of_rank(tasks, rank, 4) for rank in range(4)) == [[], [], [], tasks]
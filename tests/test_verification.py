@@ -0,0 +1,219 @@
+"""
+Check the COG layout of (Big)TIFFs served from a local S3 stand-in with ranged reads
+"""
+import struct
+
+import numpy
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+tifffile = pytest.importorskip('tifffile')
+
+from dea_cogger.verification import RemoteTIFFException, _RangeReader, _read_ifds, \
+    validate_remote_geotiff  # noqa: E402
+
+BUCKET = 'test-bucket'
+TILE = 256
+
+# TIFF field types of the tags written below
+SHORT, LONG, LONG8 = 3, 4, 16
+FIELD_FORMATS = {SHORT: 'H', LONG: 'L', LONG8: 'Q'}
+
+
+@pytest.fixture
+def s3():
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def _upload(s3, tmp_path, name):
+    url = f's3://{BUCKET}/{name}'
+    s3.upload_file(str(tmp_path / name), BUCKET, name)
+    return url
+
+
+def _pyramid(empty_top_left=False):
+    """
+    A 1024x768 int16 image and its two overviews, optionally zero in the top left 512x512 pixels, which leaves
+    the first tiles of the image and of its first overview empty
+    """
+    data = numpy.arange(1024 * 768, dtype='int32').reshape(768, 1024).astype('int16') | 1
+    if empty_top_left:
+        data[:2 * TILE, :2 * TILE] = 0
+    return [data, data[::2, ::2], data[::4, ::4]]
+
+
+def _tiles(level):
+    rows, cols = -(-level.shape[0] // TILE), -(-level.shape[1] // TILE)
+    padded = numpy.zeros((rows * TILE, cols * TILE), dtype=level.dtype)
+    padded[:level.shape[0], :level.shape[1]] = level
+    return [padded[row * TILE:(row + 1) * TILE, col * TILE:(col + 1) * TILE].tobytes()
+            for row in range(rows) for col in range(cols)]
+
+
+def _ifd(entries, ifd_offset, next_ifd_offset, bigtiff):
+    """
+    Pack an IFD at `ifd_offset`, followed by the values which don't fit in its entries
+    """
+    count_fmt, offset_fmt, offset_size = ('Q', 'Q', 8) if bigtiff else ('H', 'L', 4)
+    values_offset = ifd_offset + struct.calcsize('<' + count_fmt) + len(entries) * (4 + 2 * offset_size) + offset_size
+
+    packed_entries, values = b'', b''
+    for tag, field_type, tag_values in sorted(entries):
+        packed = struct.pack(f'<{len(tag_values)}{FIELD_FORMATS[field_type]}', *tag_values)
+        if len(packed) <= offset_size:
+            value = packed.ljust(offset_size, b'\0')
+        else:
+            value = struct.pack('<' + offset_fmt, values_offset + len(values))
+            values += packed
+        packed_entries += struct.pack(f'<HH{offset_fmt}', tag, field_type, len(tag_values)) + value
+
+    next_ifd = struct.pack('<' + offset_fmt, next_ifd_offset)
+    return struct.pack('<' + count_fmt, len(entries)) + packed_entries + next_ifd + values
+
+
+def write_tiff(path, levels, bigtiff=False, cog=True, sparse=False):
+    """
+    Write an uncompressed tiled int16 (Big)TIFF of an image and its overviews
+
+    As a COG, the IFDs follow the header and the tiles are written from the smallest overview to the
+    full resolution image. Otherwise the tiles follow the header, in the opposite order, and the IFDs
+    are at the end of the file. With `sparse`, tiles of nothing but zeros aren't written.
+    """
+    tiles = [_tiles(level) for level in levels]
+    header_size = 16 if bigtiff else 8
+
+    def entries(level_no, offsets):
+        height, width = levels[level_no].shape
+        byte_counts = [TILE * TILE * 2 if offset else 0 for offset in offsets]
+        return [(254, LONG, [1 if level_no else 0]), (256, LONG, [width]), (257, LONG, [height]),
+                (258, SHORT, [16]), (259, SHORT, [1]), (262, SHORT, [1]), (277, SHORT, [1]),
+                (322, SHORT, [TILE]), (323, SHORT, [TILE]),
+                (324, LONG8 if bigtiff else LONG, offsets), (325, LONG, byte_counts), (339, SHORT, [2])]
+
+    # IFD sizes don't depend on the offsets they hold
+    ifd_sizes = [len(_ifd(entries(level_no, [1] * len(level_tiles)), 0, 0, bigtiff))
+                 for level_no, level_tiles in enumerate(tiles)]
+
+    data_size = sum(len(tile) for level_tiles in tiles for tile in level_tiles)
+    if cog:
+        ifds_start, data_start = header_size, header_size + sum(ifd_sizes)
+    else:
+        ifds_start, data_start = header_size + data_size, header_size
+
+    contents = bytearray(header_size + sum(ifd_sizes) + data_size)
+    offsets = [None] * len(levels)
+    position = data_start
+    for level_no in (reversed(range(len(levels))) if cog else range(len(levels))):
+        offsets[level_no] = []
+        for tile in tiles[level_no]:
+            if sparse and not any(tile):
+                offsets[level_no].append(0)
+                continue
+            contents[position:position + len(tile)] = tile
+            offsets[level_no].append(position)
+            position += len(tile)
+
+    ifd_offsets = [ifds_start + sum(ifd_sizes[:level_no]) for level_no in range(len(levels))]
+    for level_no, ifd_offset in enumerate(ifd_offsets):
+        next_ifd_offset = ifd_offsets[level_no + 1] if level_no + 1 < len(levels) else 0
+        ifd = _ifd(entries(level_no, offsets[level_no]), ifd_offset, next_ifd_offset, bigtiff)
+        contents[ifd_offset:ifd_offset + len(ifd)] = ifd
+
+    if bigtiff:
+        contents[:header_size] = struct.pack('<2sHHHQ', b'II', 43, 8, 0, ifd_offsets[0])
+    else:
+        contents[:header_size] = struct.pack('<2sHL', b'II', 42, ifd_offsets[0])
+
+    with open(path, 'wb') as fout:
+        fout.write(contents[:position] if cog else contents)
+
+
+def _assert_pixels(path, levels):
+    # The files are real TIFFs, whatever the layout
+    with tifffile.TiffFile(str(path)) as tif:
+        assert len(tif.pages) == len(levels)
+        for page, level in zip(tif.pages, levels):
+            numpy.testing.assert_array_equal(page.asarray(), level)
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+def test_valid_cog(s3, tmp_path, bigtiff):
+    levels = _pyramid()
+    write_tiff(tmp_path / 'cog.tif', levels, bigtiff=bigtiff)
+    _assert_pixels(tmp_path / 'cog.tif', levels)
+
+    url = _upload(s3, tmp_path, 'cog.tif')
+    assert validate_remote_geotiff(url, s3) == (url, [])
+
+    # Every IFD is within the first ranged read
+    reader = _RangeReader(url, s3)
+    assert len(_read_ifds(reader)) == len(levels)
+    assert reader.requests == 1
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+def test_ifds_beyond_first_read(s3, tmp_path, bigtiff):
+    write_tiff(tmp_path / 'cog.tif', _pyramid(), bigtiff=bigtiff)
+    url = _upload(s3, tmp_path, 'cog.tif')
+
+    reader = _RangeReader(url, s3, initial_bytes=64)
+    ifds = _read_ifds(reader)
+    assert [tags[256] for _, tags in ifds] == [1024, 512, 256]
+    assert reader.requests > 1
+    # Everything read is near the start of the file, no tile data is fetched
+    assert reader.bytes_read < (tmp_path / 'cog.tif').stat().st_size // 4
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+def test_ifd_at_end(s3, tmp_path, bigtiff):
+    levels = _pyramid()
+    write_tiff(tmp_path / 'not_cog.tif', levels, bigtiff=bigtiff, cog=False)
+    _assert_pixels(tmp_path / 'not_cog.tif', levels)
+
+    url = _upload(s3, tmp_path, 'not_cog.tif')
+    _, errors = validate_remote_geotiff(url, s3)
+    assert len(errors) == 1 and 'offset of the main IFD' in errors[0]
+
+    # Fails on the header, without following the IFDs to the end of the file
+    reader = _RangeReader(url, s3)
+    with pytest.raises(RemoteTIFFException):
+        _read_ifds(reader)
+    assert reader.requests == 1
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+def test_tifffile_pages_not_cog(s3, tmp_path, bigtiff):
+    # tifffile writes each IFD followed by its tiles, so the full resolution tiles come first
+    with tifffile.TiffWriter(str(tmp_path / 'pages.tif'), bigtiff=bigtiff) as tif:
+        for level_no, level in enumerate(_pyramid()):
+            tif.write(level, tile=(TILE, TILE), subfiletype=1 if level_no else 0)
+
+    url = _upload(s3, tmp_path, 'pages.tif')
+    _, errors = validate_remote_geotiff(url, s3)
+    assert errors == ['The imagery should start with the smallest overview and end with the main image']
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+def test_sparse_cog(s3, tmp_path, bigtiff):
+    levels = _pyramid(empty_top_left=True)
+    write_tiff(tmp_path / 'sparse.tif', levels, bigtiff=bigtiff, sparse=True)
+    _assert_pixels(tmp_path / 'sparse.tif', levels)
+
+    url = _upload(s3, tmp_path, 'sparse.tif')
+    reader = _RangeReader(url, s3)
+    first_offsets = [tags[324] for _, tags in _read_ifds(reader)]
+    # The first written tile of each image is kept, not the zero offset of its empty top left tile
+    assert all(first_offsets)
+    assert first_offsets == sorted(first_offsets, reverse=True)
+
+    assert validate_remote_geotiff(url, s3) == (url, [])
+
+
+def test_not_a_tiff(s3, tmp_path):
+    (tmp_path / 'text.tif').write_bytes(b'not a TIFF at all')
+    url = _upload(s3, tmp_path, 'text.tif')
+    assert validate_remote_geotiff(url, s3) == (url, ['The file is not a TIFF'])